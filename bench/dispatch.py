@@ -0,0 +1,80 @@
+# Microbenchmark of TreeWalker action dispatch on a synthetic tree.
+#
+# Run it inside gdb after loading the plugin, no inferior is needed:
+#   gdb -batch -x postgres-gdb.py -x bench/dispatch.py
+import random
+import timeit
+
+import gdb
+from __main__ import TreeWalker
+
+class FakeField(object):
+    def __init__(self, typ, is_base_class):
+        self.type = typ
+        self.is_base_class = is_base_class
+
+class FakeType(object):
+    """Mimics the gdb.Type attributes used by TreeWalker"""
+    def __init__(self, name, base=None):
+        self.code = gdb.TYPE_CODE_STRUCT
+        self.name = name
+        self._fields = [FakeField(base, True)] if base else []
+        self._pointer = None
+
+    def fields(self):
+        return self._fields
+
+    def pointer(self):
+        if self._pointer is None:
+            self._pointer = FakePointer(self)
+        return self._pointer
+
+class FakePointer(object):
+    def __init__(self, target):
+        self.code = gdb.TYPE_CODE_PTR
+        self.name = None
+        self._target = target
+
+    def target(self):
+        return self._target
+
+    def fields(self):
+        return self._target.fields()
+
+class BenchWalker(TreeWalker):
+    def show_(self, val):
+        return ''
+    def walk_(self, val):
+        return []
+    def show_OpExpr(self, val):
+        return ''
+    def walk_List(self, val):
+        return []
+    def show_Scan(self, val):
+        return ''
+
+def synthetic_tree(nodes):
+    scan = FakeType('Scan')
+    typs = [FakeType(name) for name in ('OpExpr', 'Var', 'Const', 'List', 'FuncExpr', 'BoolExpr')]
+    typs += [FakeType(name, scan) for name in ('SeqScan', 'IndexScan')]
+    rand = random.Random(0)
+    return [rand.choice(typs).pointer() for _ in range(nodes)]
+
+def old_dispatch(walker, tree):
+    for typ in tree:
+        walker.get_action_func(typ, walker.SHOW_FUNC_PREFIX)
+        walker.get_action_func(typ, walker.WALK_FUNC_PREFIX)
+
+def new_dispatch(walker, tree):
+    for typ in tree:
+        walker.get_actions(typ)
+
+def main(nodes=20000, repeat=5):
+    walker = BenchWalker()
+    tree = synthetic_tree(nodes)
+    old = min(timeit.repeat(lambda: old_dispatch(walker, tree), number=1, repeat=repeat))
+    new = min(timeit.repeat(lambda: new_dispatch(walker, tree), number=1, repeat=repeat))
+    print(f'{nodes} nodes: get_action_func x2 {old * 1000:.2f} ms, '
+          f'get_actions {new * 1000:.2f} ms ({old / new:.1f}x)')
+
+main()
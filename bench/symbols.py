@@ -0,0 +1,55 @@
+# Hit rate of the pc to symbol cache over repeated attaches, as pg profile
+# does for every sample, with the objfile loads simulated.
+#
+# Run it inside gdb after loading the plugin, no inferior is needed:
+#   gdb -batch -x postgres-gdb.py -x bench/symbols.py
+import random
+
+from __main__ import SymbolCache
+
+class FakeSal(object):
+    symtab = None
+    line = 0
+
+class FakeFrame(object):
+    """Mimics the gdb.Frame methods used by SymbolCache"""
+    def __init__(self, pc):
+        self._pc = pc
+
+    def pc(self):
+        return self._pc
+
+    def type(self):
+        return 0
+
+    def name(self):
+        return f'func_{self._pc:x}'
+
+    def find_sal(self):
+        return FakeSal()
+
+POSTMASTER = {'/usr/lib/postgresql/bin/postgres': ('b1', 0x555555554000),
+              '/usr/lib/x86_64-linux-gnu/libc.so.6': ('b2', 0x7ffff7c00000)}
+
+def attach(cache, objfiles, pcs, samples=100):
+    """Simulate an attach loading OBJFILES, then unwind SAMPLES stacks"""
+    cache.loaded_objfiles = lambda: dict(objfiles)
+    cache.new_objfile(None)
+    rand = random.Random(0)
+    for _ in range(samples):
+        for pc in rand.sample(pcs, 10):
+            cache.resolve(FakeFrame(pc))
+
+def run(name, attaches):
+    cache = SymbolCache()
+    pcs = [0x555555554000 + i * 64 for i in range(50)]
+    for objfiles in attaches:
+        attach(cache, objfiles, pcs)
+    print(f'{name}: {cache.stats()}')
+
+# backends of one postmaster share the entries
+run('same postmaster', [POSTMASTER] * 3)
+# an extension dlopen()ed at another address in one backend drops them
+extension = '/usr/lib/postgresql/lib/plpgsql.so'
+run('extension moved', [dict(POSTMASTER, **{extension: ('b3', 0x7ffff7a00000)}),
+                        dict(POSTMASTER, **{extension: ('b3', 0x7ffff7800000)})])
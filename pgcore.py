@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Analyze a directory of postgres core files in parallel gdb sessions.
+
+Every core is opened by a gdb of its own running 'pg report', which writes
+the stack and the output of a command script as CORE.json in the output
+directory. The cores are then clustered by crash signature into
+summary.json. A core whose report is already in the output directory is not
+analyzed again unless it changed.
+"""
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import os
+import re
+import subprocess
+import sys
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def quote(arg):
+    """Quote ARG for gdb.string_to_argv()"""
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def gdb_command(args, core, output):
+    report = f'pg report -o {quote(output)}'
+    if args.script:
+        report += f' -x {quote(os.path.abspath(args.script))}'
+    return [args.gdb, '-batch', '-nx', '-q',
+            '-ex', 'set pagination off',
+            '-ex', f'python import sys; sys.path.insert(0, {PLUGIN_DIR!r})',
+            '-x', os.path.join(PLUGIN_DIR, 'postgres-gdb.py'),
+            '-ex', report, args.postgres, core]
+
+def core_stamp(core):
+    stat = os.stat(core)
+    return [stat.st_size, stat.st_mtime]
+
+def report_path(args, core):
+    return os.path.abspath(os.path.join(args.output_dir,
+                                        os.path.basename(core) + '.json'))
+
+def load_report(args, core):
+    """Return the report of CORE made by an earlier run, if still valid"""
+    try:
+        with open(report_path(args, core)) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if report.get('core') != core or report.get('stamp') != core_stamp(core):
+        return None
+    return report
+
+def analyze(args, core):
+    """Run gdb on CORE and return its report"""
+    output = report_path(args, core)
+    if os.path.exists(output):
+        os.remove(output)
+    try:
+        proc = subprocess.run(gdb_command(args, core, output), capture_output=True,
+                              text=True, timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        return {'core': core, 'error': f'gdb timed out after {args.timeout}s'}
+    try:
+        with open(output) as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return {'core': core, 'error': proc.stderr.strip() or 'no report written'}
+    report['core'] = core
+    report['stamp'] = core_stamp(core)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+# compiler generated clones such as foo.isra.0 or foo.part.1
+CLONE_SUFFIX = re.compile(r'\.(isra|constprop|part|cold|lto_priv)(\.\d+)*')
+
+def crash_signature(report, frames):
+    """Top FRAMES function names, the executor node and the plan root tag"""
+    if 'stack' not in report:
+        return 'error: ' + report.get('error', '')
+    names = [CLONE_SUFFIX.sub('', frame['function']) for frame in report['stack']]
+    return ' | '.join((';'.join(names[:frames]),
+                       report.get('executor_node') or '-',
+                       report.get('plan_root') or '-'))
+
+def summarize(reports, frames):
+    """Cluster the reports by crash signature, largest cluster first"""
+    clusters = {}
+    for report in sorted(reports, key=lambda r: r['core']):
+        clusters.setdefault(crash_signature(report, frames), []).append(report)
+    summary = []
+    for key, members in sorted(clusters.items(), key=lambda c: -len(c[1])):
+        first = members[0]
+        summary.append({'signature': key, 'count': len(members),
+                        'representative': {'core': first['core'],
+                                           'signal': first.get('signal'),
+                                           'query': first.get('query')},
+                        'cores': [r['core'] for r in members]})
+    return summary
+
+def find_cores(directory, pattern):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if fnmatch.fnmatch(name, pattern)
+                  and os.path.isfile(os.path.join(directory, name)))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cores', help='directory of core files')
+    parser.add_argument('-p', '--postgres', required=True,
+                        help='postgres binary the cores come from')
+    parser.add_argument('-x', '--script',
+                        help='gdb commands to run on each core, one per line')
+    parser.add_argument('-o', '--output-dir', default='core-reports')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--pattern', default='core*', help='names of the core files')
+    parser.add_argument('--timeout', type=int, default=300,
+                        help='seconds one gdb session may take')
+    parser.add_argument('--frames', type=int, default=10,
+                        help='number of top frames in the crash signature')
+    parser.add_argument('--force', action='store_true',
+                        help='analyze again cores which have a report')
+    parser.add_argument('--gdb', default='gdb')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    cores = find_cores(args.cores, args.pattern)
+    if not cores:
+        print(f'No core file matching {args.pattern} in {args.cores}')
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+    reports = []
+    todo = []
+    for core in cores:
+        report = None if args.force else load_report(args, core)
+        if report is None:
+            todo.append(core)
+        else:
+            reports.append(report)
+    if reports:
+        print(f'{len(reports)} cores already analyzed, {len(todo)} new')
+    # Each job is a gdb process, threads are enough to keep them running.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = [pool.submit(analyze, args, core) for core in todo]
+        for i, job in enumerate(concurrent.futures.as_completed(jobs)):
+            report = job.result()
+            reports.append(report)
+            status = report.get('error') or report.get('signal') or 'done'
+            print(f'[{i + 1}/{len(todo)}] {report["core"]}: {status}')
+    summary = summarize(reports, args.frames)
+    with open(os.path.join(args.output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    for cluster in summary:
+        print(f'{cluster["count"]:6} {cluster["signature"]}')
+        print(f'{"":6} e.g. {cluster["representative"]["core"]}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
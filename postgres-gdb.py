@@ -1,47 +1,293 @@
+import collections
+import json
 import os.path
 import re
-import subprocess
+import signal
+import struct
+import threading
+import time
 import argparse
+import gdb.types
 from autocvar import autocvar, AutoNumCVar
+from procfs import ProcScanner
 
 
 gdb.Command('pg', gdb.COMMAND_DATA, prefix=True)
 
+class TypeRegistry(object):
+    """Cache of gdb type lookups, dropped whenever the objfiles change"""
+
+    def __init__(self):
+        self.types = {}
+        self.node_types = {}
+        self.layouts = {}
+        self._endian = None
+        self.hits = 0
+        self.misses = 0
+        gdb.events.new_objfile.connect(self.invalidate)
+        gdb.events.clear_objfiles.connect(self.invalidate)
+
+    def invalidate(self, event=None):
+        self.types.clear()
+        self.node_types.clear()
+        self.layouts.clear()
+        self._endian = None
+
+    @property
+    def endian(self):
+        """struct byte order prefix of the target"""
+        if self._endian is None:
+            show = gdb.execute('show endian', to_string=True)
+            self._endian = '>' if 'big endian' in show else '<'
+        return self._endian
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, name):
+        typ = self.types.get(name)
+        if typ is not None:
+            self.hits += 1
+            return typ
+        self.misses += 1
+        typ = gdb.lookup_type(name)
+        self.types[name] = typ
+        return typ
+
+    def node_type(self, val):
+        """Return the struct type of the Node pointed by VAL from its NodeTag"""
+        tag = int(val['type'])
+        typ = self.node_types.get(tag)
+        if typ is not None:
+            self.hits += 1
+            return typ
+        # str() gives the enumerator name, e.g. T_SeqScan
+        typ = self.lookup(str(val['type'])[2:])
+        self.node_types[tag] = typ
+        return typ
+
+    def layout(self, name, fields):
+        """Return the StructLayout of FIELDS of struct NAME"""
+        key = (name, tuple(fields))
+        layout = self.layouts.get(key)
+        if layout is None:
+            layout = self.layouts[key] = StructLayout(self.lookup(name), fields)
+        return layout
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits * 100.0 / total if total else 0.0
+        return f'{len(self.types)} types, {len(self.node_types)} node tags, ' \
+            f'{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)'
+
+types = TypeRegistry()
+
+class SymbolCache(object):
+    """LRU cache of frame pc -> (function name, source file, line)
+
+    The entries hold while every objfile stays where it was when they were
+    made. Each objfile is recorded as its filename -> (build id, load
+    address) and the record outlives attaching and detaching: the backends
+    of one postmaster map the same objfiles at the same addresses and share
+    the entries. An objfile not recorded yet, or loaded elsewhere, such as an
+    extension library dlopen()ed at another address, drops them.
+    """
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        # filename -> (build id, load address) of every objfile seen
+        self.objfiles = {}
+        # objfiles were loaded since the record was last compared
+        self.check_pending = False
+        self.hits = 0
+        self.misses = 0
+        gdb.events.new_objfile.connect(self.new_objfile)
+
+    def new_objfile(self, event):
+        # the load addresses are known once the inferior is fully attached,
+        # they are compared at the next lookup
+        self.check_pending = True
+
+    def loaded_objfiles(self):
+        """Return filename -> (build id, load address) of the loaded objfiles"""
+        addresses = {}
+        info = gdb.execute('info sharedlibrary', to_string=True)
+        for match in re.finditer(r'^(0x[0-9a-f]+)\s+0x[0-9a-f]+\s+\S+(?:\s+\(\*\))?'
+                                 r'\s+(\S.*?)\s*$', info, re.MULTILINE):
+            addresses[os.path.realpath(match.group(2))] = int(match.group(1), 16)
+        main = gdb.lookup_global_symbol('main')
+        progspace = gdb.current_progspace().filename
+        if main is not None and progspace:
+            # a PIE executable moves with the postmaster, main moves with it
+            addresses[os.path.realpath(progspace)] = int(main.value().address)
+        loaded = {}
+        for objfile in gdb.objfiles():
+            # separate debug info follows the objfile it belongs to
+            if getattr(objfile, 'owner', None) is not None:
+                continue
+            loaded[objfile.filename] = (getattr(objfile, 'build_id', None),
+                                        addresses.get(objfile.filename))
+        return loaded
+
+    def check_objfiles(self):
+        self.check_pending = False
+        changed = False
+        for name, ident in self.loaded_objfiles().items():
+            if self.objfiles.get(name) != ident:
+                self.objfiles[name] = ident
+                changed = True
+        if changed:
+            self.invalidate()
+
+    def invalidate(self, event=None):
+        self.entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, frame, depth=0):
+        """DEPTH counts the inline frames newer than FRAME at the same pc,
+        all the functions of an inline chain share that pc"""
+        if self.check_pending:
+            self.check_objfiles()
+        key = (frame.pc(), frame.type(), depth)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        sal = frame.find_sal()
+        entry = (frame.name() or '??',
+                 sal.symtab.filename if sal.symtab is not None else None, sal.line)
+        self.entries[key] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def unwind(self):
+        """Yield (frame, (function name, source file, line)) of the selected
+        thread, innermost first"""
+        frame = gdb.newest_frame()
+        newer = None
+        depth = 0
+        while frame is not None:
+            if newer is not None and newer.type() == gdb.INLINE_FRAME \
+               and newer.pc() == frame.pc():
+                depth += 1
+            else:
+                depth = 0
+            yield frame, self.resolve(frame, depth)
+            newer = frame
+            frame = frame.older()
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits * 100.0 / total if total else 0.0
+        return f'{len(self.entries)} pcs, ' \
+            f'{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)'
+
+symbols = SymbolCache()
+
+class CacheStats(gdb.Command):
+    """show hit and miss counters of the plugin caches
+usage: pg cache [-r|--reset]"""
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg cache", gdb.COMMAND_DATA)
+        self.caches = {'types': types, 'symbols': symbols}
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        parser = argparse.ArgumentParser(prog='pg cache')
+        parser.add_argument('-r', '--reset', action='store_true')
+        args = parser.parse_args(argv)
+        for name, cache in self.caches.items():
+            print(f'{name}: {cache.stats()}')
+            if args.reset:
+                cache.reset_stats()
+CacheStats()
+
+def add_inferior():
+    """Add an empty inferior, switch to it and return its number"""
+    nums = {inf.num for inf in gdb.inferiors()}
+    gdb.execute("add-inferior", to_string=True)
+    num = max(inf.num for inf in gdb.inferiors() if inf.num not in nums)
+    gdb.execute(f"inferior {num}", to_string=True)
+    return num
+
 class BackendAttach(gdb.Command):
     """attach user postgres backend"""
 
+    ignore_types = ('checkpointer', 'background writer', 'walwriter',
+                    'autovacuum launcher', 'logical replication launcher')
+
     def __init__ (self):
         super (self.__class__, self).__init__ ("pg attach", gdb.COMMAND_RUNNING)
         self.backends = ()
         self.pid = None
+        self.scanner = ProcScanner()
+        self.cpu_usage = {}
 
     def attach(self):
         gdb.execute(f"attach {self.pid}")
 
+    def attach_all(self):
+        """Attach every selected backend, each in an inferior of its own"""
+        attached = {inf.pid for inf in gdb.inferiors() if inf.pid != 0}
+        for backend in self.backends:
+            if backend.pid in attached:
+                continue
+            if gdb.selected_inferior().pid != 0:
+                add_inferior()
+            self.pid = backend.pid
+            self.attach()
+
     def grab_backends(self, datadir):
-        pidfile = os.path.expanduser(os.path.join(datadir.string(), 'postmaster.pid'))
-        master_pid = 0
-        with open(pidfile) as f:
-            master_pid = f.readline().strip()
-        if not master_pid:
-            return
-        pscmd = 'ps -o pid=,cmd= --ppid=%s' % master_pid
-        output = subprocess.getoutput(pscmd)
-        def split_cmdline(line):
-            match = re.match(r'\s*(\d+)\s+', line)
-            return (match.group(1), line[match.end():])
-        processes = [split_cmdline(line) for line in output.split('\n')]
-        ignore_titles = ('postgres: checkpointer', 'postgres: background writer', 'postgres: walwriter',
-                         'postgres: autovacuum launcher', 'postgres: logical replication launcher')
-        backends = [(int(p[0]), p[1]) for p in filter(lambda p : p[1].strip() not in ignore_titles, processes)]
+        backends = [b for b in self.scanner.scan_datadir(datadir.string())
+                    if b.backend_type not in self.ignore_types]
+        self.backends = backends
         if not backends:
             gdb.write("No postgres backend found\n")
-            return
-        self.backends = backends
 
     def print_backends(self):
-        for i, (pid, title) in enumerate(self.backends):
-            print(f"{i + 1}. {pid} {title}")
+        for i, backend in enumerate(self.backends):
+            usage = self.cpu_usage.get(backend.pid)
+            cpu = f" ({usage:.0%} CPU)" if usage is not None else ''
+            print(f"{i + 1}. {backend.pid}{cpu} {backend.title}")
+
+    @staticmethod
+    def add_selection_arguments(parser):
+        parser.add_argument('--state', help='only backends in this state, e.g. active')
+        parser.add_argument('--match', help='only backends whose title matches this regex')
+        order = parser.add_mutually_exclusive_group()
+        order.add_argument('--top-cpu', action='store_true',
+                           help='order by CPU used during --interval seconds')
+        order.add_argument('--oldest', action='store_true',
+                           help='order by process start time')
+        parser.add_argument('--interval', type=float, default=0.5,
+                            help='CPU sampling window of --top-cpu')
+
+    def select_backends(self, args):
+        """Filter and order the grabbed backends by the selection arguments"""
+        backends = self.backends
+        if args.state:
+            backends = [b for b in backends if b.state == args.state]
+        if args.match:
+            pattern = re.compile(args.match)
+            backends = [b for b in backends if pattern.search(b.title)]
+        self.cpu_usage = {}
+        if args.top_cpu and backends:
+            self.cpu_usage = self.scanner.cpu_usage([b.pid for b in backends],
+                                                    args.interval)
+            backends = sorted(backends, reverse=True,
+                              key=lambda b: self.cpu_usage.get(b.pid, -1))
+        elif args.oldest:
+            backends = sorted(backends, key=lambda b: b.start_time)
+        return backends
 
     def invoke (self, arg, from_tty):
         argv = gdb.string_to_argv(arg)
@@ -49,21 +295,36 @@ class BackendAttach(gdb.Command):
         parser.add_argument('-f', '--force', action='store_true')
         parser.add_argument('-i', '--interactive', action='store_true')
         parser.add_argument('-l', '--list', action='store_true')
+        parser.add_argument('-a', '--all', action='store_true',
+                            help='attach all selected backends in new inferiors')
+        parser.add_argument('filter', nargs='?',
+                            help='regex the title of --all backends must match')
+        self.add_selection_arguments(parser)
         args = parser.parse_args(argv)
+        if args.filter:
+            args.match = args.filter
         cur = gdb.selected_inferior()
-        if not args.force and cur.pid != 0:
+        if not args.force and not args.all and cur.pid != 0:
             gdb.write(f"Process {cur.pid} has already attached.\n")
             return
         self.grab_backends(gdb.convenience_variable("datadir"))
         if not self.backends:
             return
-        self.pid = self.backends[0][0]
+        self.backends = self.select_backends(args)
+        if not self.backends:
+            gdb.write("No postgres backend matches\n")
+            return
+        self.pid = self.backends[0].pid
 
         if args.list:
             self.print_backends()
             return
+        if args.all:
+            self.attach_all()
+            return
 
-        multiple = len(self.backends) > 1
+        # --top-cpu and --oldest already ordered the best one first
+        multiple = len(self.backends) > 1 and not (args.top_cpu or args.oldest)
         if multiple:
             gdb.write("There are more than 1 backends:\n")
             self.print_backends()
@@ -72,68 +333,546 @@ class BackendAttach(gdb.Command):
                 if index <= 0 or index > len(self.backends):
                     gdb.write("Invalid process input")
                     return
-                self.pid = self.backends[index - 1][0]
+                self.pid = self.backends[index - 1].pid
         if cur.pid != 0:
             gdb.execute("detach")
         self.attach()
-BackendAttach()
+backend_attach = BackendAttach()
+
+class ForeachInferior(gdb.Command):
+    """run a command in every attached inferior
+usage: pg foreach [-g|--group] COMMAND
+  -g, --group  print inferiors with the same output together"""
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg foreach", gdb.COMMAND_RUNNING)
+
+    def invoke(self, arg, from_tty):
+        group = False
+        if arg.startswith(('-g ', '--group ')):
+            group = True
+            arg = arg.split(None, 1)[1]
+        if not arg:
+            print("usage: pg foreach [-g|--group] COMMAND")
+            return
+        cur = gdb.selected_inferior()
+        outputs = []
+        try:
+            for inf in gdb.inferiors():
+                if inf.pid == 0:
+                    continue
+                gdb.execute(f"inferior {inf.num}", to_string=True)
+                try:
+                    output = gdb.execute(arg, to_string=True)
+                except gdb.error as e:
+                    output = f"{e}\n"
+                outputs.append((f"inferior {inf.num} (pid {inf.pid})", output))
+        finally:
+            gdb.execute(f"inferior {cur.num}", to_string=True)
+        if group:
+            groups = {}
+            for name, output in outputs:
+                groups.setdefault(output, []).append(name)
+            outputs = [(f"{len(names)} x " + ', '.join(names), output) for output, names
+                       in sorted(groups.items(), key=lambda g: -len(g[1]))]
+        gdb.write(''.join(f"=== {name} ===\n{output}" for name, output in outputs))
+ForeachInferior()
+
+def collect_stack(max_frames=None):
+    """Return the function names of the selected thread, innermost first.
+
+    Only MAX_FRAMES frames are unwound, a truncated stack ends with '...'.
+    """
+    stack = []
+    for frame, (function, filename, line) in symbols.unwind():
+        if max_frames is not None and len(stack) >= max_frames:
+            stack.append('...')
+            break
+        stack.append(function)
+    return stack
+
+class StackProfile(object):
+    """Aggregate of sampled stacks"""
+
+    def __init__(self):
+        # stack, outermost frame first -> number of samples
+        self.stacks = {}
+        self.samples = 0
+
+    def add(self, stack):
+        key = tuple(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def folded(self):
+        """Return the stacks in the folded format read by flame graph tools"""
+        return ''.join(f"{';'.join(stack)} {count}\n"
+                       for stack, count in sorted(self.stacks.items()))
+
+    def functions(self):
+        """Return function -> [inclusive, exclusive] sample counts"""
+        counts = {}
+        for stack, count in self.stacks.items():
+            for name in set(stack):
+                counts.setdefault(name, [0, 0])[0] += count
+            if stack:
+                counts[stack[-1]][1] += count
+        return counts
+
+    def report(self, top, sort_by='exclusive'):
+        column = 0 if sort_by == 'inclusive' else 1
+        ranked = sorted(self.functions().items(),
+                        key=lambda f: (-f[1][column], -f[1][1 - column], f[0]))
+        lines = [f"{self.samples} samples, {len(self.stacks)} distinct stacks",
+                 f"{'inclusive':>16} {'exclusive':>16}  function"]
+        total = self.samples or 1
+        for name, (inclusive, exclusive) in ranked[:top]:
+            lines.append(f"{inclusive:>8} {inclusive / total:>7.1%} "
+                         f"{exclusive:>8} {exclusive / total:>7.1%}  {name}")
+        return ''.join(line + '\n' for line in lines)
+
+class Profiler(gdb.Command):
+    """sample stacks of backends and aggregate the identical ones
+usage: pg profile [-n SAMPLES] [-s SECONDS] [--top N] [--sort-by inclusive|exclusive]
+                  [-o FILE] [--state STATE] [--match REGEX] [PID ...]
+Without PIDs the backends are selected like with pg attach. -o writes the
+stacks in folded format for flame graph tools."""
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg profile", gdb.COMMAND_RUNNING)
+
+    def make_parser(self, prog):
+        parser = argparse.ArgumentParser(prog=prog)
+        parser.add_argument('-n', '--samples', type=int, default=100)
+        parser.add_argument('-s', '--sample-interval', type=float, default=0.1,
+                            help='seconds between two samples of a backend')
+        parser.add_argument('--top', type=int, default=20)
+        parser.add_argument('--sort-by', choices=('inclusive', 'exclusive'),
+                            default='exclusive')
+        parser.add_argument('-o', '--output', help='write folded stacks to this file')
+        BackendAttach.add_selection_arguments(parser)
+        parser.add_argument('pids', type=int, nargs='*')
+        return parser
+
+    def parse_args(self, arg):
+        return self.make_parser('pg profile').parse_args(gdb.string_to_argv(arg))
+
+    def select_pids(self, args):
+        if args.pids:
+            return args.pids
+        backend_attach.grab_backends(gdb.convenience_variable("datadir"))
+        return [b.pid for b in backend_attach.select_backends(args)]
+
+    def sample(self, pid, profile):
+        gdb.execute(f"attach {pid}", to_string=True)
+        try:
+            profile.add(collect_stack())
+        finally:
+            gdb.execute("detach", to_string=True)
+
+    def run(self, pids, args, profile):
+        for i in range(args.samples):
+            start = time.monotonic()
+            for pid in list(pids):
+                try:
+                    self.sample(pid, profile)
+                except gdb.error as e:
+                    gdb.write(f"Stop sampling {pid}: {e}\n")
+                    pids.remove(pid)
+            if not pids:
+                break
+            delay = args.sample_interval - (time.monotonic() - start)
+            if delay > 0 and i < args.samples - 1:
+                time.sleep(delay)
+
+    def invoke(self, arg, from_tty):
+        args = self.parse_args(arg)
+        attached = {inf.pid for inf in gdb.inferiors()}
+        pids = [pid for pid in self.select_pids(args) if pid not in attached]
+        if not pids:
+            gdb.write("No backend to sample\n")
+            return
+        profile = StackProfile()
+        # Sample in an inferior of our own to leave the current one alone
+        cur = gdb.selected_inferior()
+        num = add_inferior()
+        try:
+            self.run(pids, args, profile)
+        except KeyboardInterrupt:
+            gdb.write("Interrupted, reporting the samples taken so far\n")
+        finally:
+            gdb.execute(f"inferior {cur.num}", to_string=True)
+            gdb.execute(f"remove-inferiors {num}", to_string=True)
+        if args.output:
+            with open(os.path.expanduser(args.output), 'w') as f:
+                f.write(profile.folded())
+        gdb.write(profile.report(args.top, args.sort_by))
+Profiler()
+
+class SignalHandling(object):
+    """Temporarily change how gdb handles some signals"""
+
+    def __init__(self, signals, actions):
+        self.signals = signals
+        self.actions = actions
+        self.saved = {}
+
+    def __enter__(self):
+        for sig in self.signals:
+            # Signal  Stop  Print  Pass to program  Description
+            info = gdb.execute(f"info signals {sig}", to_string=True)
+            stop, prt, pas = info.splitlines()[1].split()[1:4]
+            # the keywords apply left to right and noprint implies nostop,
+            # stop implies print: the print one goes first
+            self.saved[sig] = ' '.join((
+                'print' if prt == 'Yes' else 'noprint',
+                'stop' if stop == 'Yes' else 'nostop',
+                'pass' if pas == 'Yes' else 'nopass'))
+            gdb.execute(f"handle {sig} {self.actions}", to_string=True)
+        return self
+
+    def __exit__(self, *exc):
+        for sig, actions in self.saved.items():
+            gdb.execute(f"handle {sig} {actions}", to_string=True)
+
+class LowPauseSampler(Profiler):
+    """sample stacks of live backends keeping each of them stopped shortly
+usage: pg sample [-n SAMPLES] [-s SECONDS] [--max-frames N] [--budget-ms MS] [-v]
+                 [--top N] [--sort-by inclusive|exclusive] [-o FILE]
+                 [--state STATE] [--match REGEX] [PID ...]
+Each backend stays attached for its whole run and is only stopped for
+unwinding: it is interrupted with SIGINT, handled as 'stop print nopass'
+(noprint would imply nostop) so that it stops the backend without being
+passed on, unwound up to --max-frames frames, whose symbols come from the
+shared pc cache, and continued at once. The pause of
+each sample is measured and compared to --budget-ms. Backends are sampled
+one after another, the others are not stopped meanwhile."""
+
+    def __init__ (self):
+        gdb.Command.__init__ (self, "pg sample", gdb.COMMAND_RUNNING)
+
+    def parse_args(self, arg):
+        parser = self.make_parser('pg sample')
+        parser.add_argument('--max-frames', type=int, default=32)
+        parser.add_argument('--budget-ms', type=float, default=5.0,
+                            help='pause of a sample above which it is reported')
+        parser.add_argument('-v', '--verbose', action='store_true',
+                            help='print the pause of every sample')
+        return parser.parse_args(gdb.string_to_argv(arg))
+
+    def sample_backend(self, pid, args, profile):
+        pauses = []
+        gdb.execute(f"attach {pid}", to_string=True)
+        inferior = gdb.selected_inferior()
+        try:
+            for i in range(args.samples):
+                # the first stop comes from attach and is not measured from
+                # its start, the others are measured from the interrupt on
+                stopped = time.monotonic()
+                if i > 0:
+                    # let it run for an interval, then interrupt it
+                    fired = []
+                    def interrupt():
+                        fired.append(time.monotonic())
+                        os.kill(pid, signal.SIGINT)
+                    timer = threading.Timer(args.sample_interval, interrupt)
+                    timer.start()
+                    try:
+                        gdb.execute("continue", to_string=True)
+                    finally:
+                        timer.cancel()
+                        timer.join()
+                    if inferior.pid == 0:
+                        gdb.write(f"Process {pid} exited\n")
+                        return pauses
+                    stopped = fired[0] if fired else time.monotonic()
+                profile.add(collect_stack(args.max_frames))
+                pauses.append(time.monotonic() - stopped)
+                if args.verbose or pauses[-1] * 1000 > args.budget_ms:
+                    gdb.write(f"{pid} sample {i + 1}: paused {pauses[-1] * 1000:.2f} ms\n")
+        finally:
+            if inferior.pid != 0:
+                gdb.execute("detach", to_string=True)
+        return pauses
+
+    def report_pauses(self, pid, pauses, budget_ms):
+        if not pauses:
+            return
+        ms = sorted(p * 1000 for p in pauses)
+        over = sum(1 for p in ms if p > budget_ms)
+        gdb.write(f"{pid}: {len(ms)} samples, pause avg {sum(ms) / len(ms):.2f} ms, "
+                  f"p50 {ms[len(ms) // 2]:.2f} ms, p99 {ms[int(len(ms) * 0.99)]:.2f} ms, "
+                  f"max {ms[-1]:.2f} ms, {over} over the {budget_ms:g} ms budget\n")
+
+    def run(self, pids, args, profile):
+        # The first stop of a sample comes from attach, the others from
+        # SIGINT; postgres signals must neither stop the backend nor be lost.
+        # SIGINT must stop, and noprint would imply nostop; the message is
+        # swallowed by continue's to_string.
+        with SignalHandling(('SIGINT',), 'stop print nopass'), \
+             SignalHandling(('SIGUSR1', 'SIGUSR2', 'SIGURG', 'SIGALRM', 'SIGPIPE'),
+                            'nostop noprint pass'):
+            for pid in pids:
+                try:
+                    pauses = self.sample_backend(pid, args, profile)
+                except gdb.error as e:
+                    gdb.write(f"Stop sampling {pid}: {e}\n")
+                    continue
+                self.report_pauses(pid, pauses, args.budget_ms)
+LowPauseSampler()
 
 class TreeWalker(object):
-    """A base class for tree traverse"""
+    """A base class for tree traverse
+
+    A walk builds a flat list of node records which is then rendered as text,
+    JSON or DOT. The records of the last walk are kept, so rendering the same
+    tree again, in another format or another page, does not walk it again
+    until the inferior runs or its memory changes.
+    """
 
     SHOW_FUNC_PREFIX = 'show_'
     WALK_FUNC_PREFIX = 'walk_'
+    FORMATS = ('text', 'json', 'dot')
 
     def __init__(self):
-        self.level_graph = []
         self.autoncvar = None
         self.current_level = 0
+        self.max_depth = None
+        self.limit = None
+        self.offset = 0
+        self.output = None
+        self.format = 'text'
+        self.lines = []
+        self.lineno = 0
+        self.truncated = False
+        # the key and the node records of the last walk
+        self.cache_key = None
+        self.nodes = None
+        # type name -> (show function, walk function, type string)
+        self.dispatch = {}
+        for event in (gdb.events.cont, gdb.events.exited, gdb.events.memory_changed,
+                      gdb.events.new_objfile, gdb.events.clear_objfiles):
+            event.connect(self.invalidate)
+
+    def invalidate(self, event=None):
+        self.cache_key = None
+        self.nodes = None
 
     def reset(self):
-        self.level_graph = []
-        self.autoncvar = AutoNumCVar()
+        self.lines = []
+        self.lineno = 0
+        self.truncated = False
+
+    def parse_args(self, prog, arg, default=None):
+        """Parse the common walker options, the rest of ARG is the expression.
+
+        DEFAULT is the expression used when ARG has none.
+        """
+        parser = argparse.ArgumentParser(prog=prog)
+        parser.add_argument('--max-depth', type=int, default=None,
+                            help='do not expand nodes below this level')
+        parser.add_argument('--format', choices=self.FORMATS, default='text')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='print at most this many lines of text')
+        parser.add_argument('--offset', type=int, default=0,
+                            help='skip this many lines of text first')
+        parser.add_argument('--output', default=None,
+                            help='write the tree to this file')
+        self.add_arguments(parser)
+        parser.add_argument('expr', nargs='*' if default else '+')
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        args.expr = ' '.join(args.expr) or default
+        self.max_depth = args.max_depth
+        self.format = args.format
+        self.limit = args.limit
+        self.offset = args.offset
+        self.output = args.output
+        return args
+
+    def add_arguments(self, parser):
+        """Add the options of a particular walker"""
+        pass
 
-    def walk(self, expr):
+    def walk_key(self, expr, args):
+        """Return what identifies a walk, its nodes are reused for the same key.
+
+        The key is the evaluated root, not the expression text, which gives
+        another node in another frame, thread or inferior.
+        """
+        return (gdb.selected_inferior().num, int(expr), args.max_depth)
+
+    def walk(self, expr, key=None):
         self.reset()
-        self.do_walk(expr, 0)
-
-    def do_walk(self, expr, level):
-        expr_typed = expr.dynamic_type
-        expr_casted = expr.cast(expr_typed)
-        self.current_level = level
-        level_graph = '  '.join(self.level_graph[:level])
-        for i, c in enumerate(self.level_graph):
-            if c == '`':
-                self.level_graph[i] = ' '
-        cname = self.autoncvar.set_var(expr_casted)
-        left_margin = "{}{}".format('' if level == 0 else '--', cname)
-        element_show_info = ''
-        show_func = self.get_action_func(expr_typed, self.SHOW_FUNC_PREFIX)
-        if show_func is not None:
-            element_show_info = show_func(expr_casted)
-        if element_show_info is not None:
-            print("{}{} ({}) {} {}".format(
-                  level_graph, left_margin, expr_typed, expr, element_show_info))
-        walk_func = self.get_action_func(expr_typed, self.WALK_FUNC_PREFIX)
-        if walk_func is None:
-            return
-        children = walk_func(expr_casted)
-        if not children:
-            return
-        if len(self.level_graph) < level + 1:
-            self.level_graph.append('|')
+        if key is None or key != self.cache_key:
+            self.nodes = self.build(expr)
+            self.cache_key = key
+        self.render(self.nodes)
+        self.flush()
+
+    def render(self, nodes):
+        if self.format == 'json':
+            self.lines = self.render_json(nodes)
+        elif self.format == 'dot':
+            self.lines = self.render_dot(nodes)
         else:
-            self.level_graph[level] = '|'
-        for i, child in enumerate(children):
-            if i == len(children) - 1:
-                self.level_graph[level] = '`'
-            self.do_walk(child, level + 1)
+            self.render_text(nodes)
+
+    def emit(self, line):
+        """Buffer one output line, honouring --offset and --limit"""
+        self.lineno += 1
+        if self.lineno > self.offset:
+            self.lines.append(line)
+
+    def is_full(self):
+        return self.limit is not None and len(self.lines) >= self.limit
+
+    def flush(self):
+        """Write the buffered lines out at once"""
+        text = ''.join(line + '\n' for line in self.lines)
+        if self.output:
+            with open(os.path.expanduser(self.output), 'w') as f:
+                f.write(text)
+            gdb.write(f"{len(self.lines)} lines written to {self.output}\n")
+        else:
+            gdb.write(text)
+        if self.truncated:
+            gdb.write(f"Output limited to {self.limit} lines, "
+                      f"use --offset {self.offset + self.limit} to see more\n")
+        self.lines = []
+
+    def build(self, expr):
+        """Walk the tree under EXPR into a list of node records.
+
+        Children are referred to by their index in the list, so neither the
+        walk nor the renderers recurse: deep trees do not hit the recursion
+        limit. A node is a marker when it has 'marker', and a reference to
+        the node of the same address shown earlier when it has 'ref'.
+        """
+        self.autoncvar = AutoNumCVar()
+        nodes = []
+        # A node shared by several parents, or reached again through a cycle
+        # in a corrupted tree, is only expanded the first time.
+        visited = {}
+        # A str entry is a marker rather than a node.
+        stack = [(expr, 0, None)]
+        while stack:
+            expr, level, parent = stack.pop()
+            self.current_level = level
+            node = {'id': len(nodes)}
+            nodes.append(node)
+            if parent is not None:
+                nodes[parent]['children'].append(node['id'])
+            if isinstance(expr, str):
+                node['marker'] = expr
+                continue
+            address = int(expr)
+            node['address'] = hex(address)
+            if address in visited:
+                node['ref'] = visited[address]
+                continue
+            visited[address] = node['id']
+            expr_typed = expr.dynamic_type
+            expr_casted = expr.cast(expr_typed)
+            show_func, walk_func, type_str = self.get_actions(expr_typed)
+            node.update(tag=self.type_name(expr_typed), type=type_str,
+                        cvar=self.autoncvar.set_var(expr_casted), children=[])
+            element_show_info = ''
+            if show_func is not None:
+                element_show_info = show_func(expr_casted)
+            if element_show_info is None:
+                node['hidden'] = True
+            elif isinstance(element_show_info, str):
+                node['info'] = element_show_info
+            else:
+                node['fields'] = {name: str(value) for name, value in element_show_info}
+            if walk_func is None:
+                continue
+            children = walk_func(expr_casted)
+            if not children:
+                continue
+            if self.max_depth is not None and level >= self.max_depth:
+                children = [f'... ({len(children)} child nodes cut at max depth)']
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((children[i], level + 1, node['id']))
+        return nodes
+
+    @staticmethod
+    def node_info(node):
+        if 'fields' in node:
+            return ', '.join(f'{name} = {value}' for name, value in node['fields'].items())
+        return node.get('info', '')
+
+    def render_text(self, nodes):
+        # Each entry carries the graph of its ancestors, which is built once
+        # per parent; a child only appends its own branch to it.
+        stack = [(0, 0, '', True)]
+        while stack and not self.is_full():
+            node_id, level, graph, last = stack.pop()
+            node = nodes[node_id]
+            prefix = graph + ('`--' if last else '|--') if level > 0 else ''
+            if 'marker' in node:
+                self.emit(prefix + node['marker'])
+            elif 'ref' in node:
+                ref = nodes[node['ref']]
+                self.emit(f"{prefix}{ref['cvar'] or ref['address']} (already shown)")
+            elif not node.get('hidden'):
+                self.emit("{}{} ({}) {} {}".format(prefix, node['cvar'], node['type'],
+                                                   node['address'], self.node_info(node)))
+            children = node.get('children')
+            if not children:
+                continue
+            child_graph = graph + (' ' if last else '|') + '  ' if level > 0 else ''
+            for i in range(len(children) - 1, -1, -1):
+                stack.append((children[i], level + 1, child_graph,
+                              i == len(children) - 1))
+        self.truncated = bool(stack)
+
+    def render_json(self, nodes):
+        return [json.dumps({'root': 0, 'nodes': nodes}, indent=1)]
+
+    def render_dot(self, nodes):
+        lines = ['digraph tree {', '  node [shape=box, fontname=monospace];']
+        for node in nodes:
+            if 'marker' in node:
+                lines.append(f"  n{node['id']} [label={json.dumps(node['marker'])}, shape=plaintext];")
+            elif 'ref' not in node:
+                label = '\n'.join(filter(None, (node['cvar'], node['type'], node['address'],
+                                                 self.node_info(node))))
+                lines.append(f"  n{node['id']} [label={json.dumps(label)}];")
+        for node in nodes:
+            for child in node.get('children', ()):
+                ref = nodes[child].get('ref')
+                if ref is None:
+                    lines.append(f"  n{node['id']} -> n{child};")
+                else:
+                    lines.append(f"  n{node['id']} -> n{ref} [style=dashed];")
+        lines.append('}')
+        return lines
+
+    @staticmethod
+    def type_name(typ):
+        if typ.code == gdb.TYPE_CODE_PTR:
+            typ = typ.target()
+        return typ.name if hasattr(typ, 'name') and typ.name is not None else str(typ)
+
+    def get_actions(self, element_type):
+        """Return the show and walk functions and the name of ELEMENT_TYPE.
+
+        gdb.Type is not hashable, so the dispatch table is keyed by type name.
+        Resolution through base classes is done only the first time a type is
+        seen.
+        """
+        key = self.type_name(element_type)
+        actions = self.dispatch.get(key)
+        if actions is None:
+            actions = (self.get_action_func(element_type, self.SHOW_FUNC_PREFIX),
+                       self.get_action_func(element_type, self.WALK_FUNC_PREFIX),
+                       str(element_type))
+            self.dispatch[key] = actions
+        return actions
 
     def get_action_func(self, element_type, action_prefix):
-        def type_name(typ):
-            if typ.code == gdb.TYPE_CODE_PTR:
-                typ = typ.target()
-            return typ.name if hasattr(typ, 'name') and typ.name is not None else str(typ)
+        type_name = self.type_name
         func_name = action_prefix + type_name(element_type)
         if hasattr(self, func_name) and callable(getattr(self, func_name)):
             return getattr(self, func_name)
@@ -157,10 +896,8 @@ class TreeWalker(object):
 
 def cast_Node(val):
     if val.type.target().code == gdb.TYPE_CODE_VOID:
-        val = val.cast(gdb.lookup_type("Node").pointer())
-    node_type = str(val['type'])
-    typ = gdb.lookup_type(node_type[2:])
-    return val.cast(typ.pointer())
+        val = val.cast(types.lookup("Node").pointer())
+    return val.cast(types.node_type(val).pointer())
 
 class ListCell:
     ptr = 1
@@ -169,13 +906,26 @@ class ListCell:
     Xid = 453
     type_values = {ptr : 'ptr_value', Int : 'int_value',
                    Oid : 'oid_value', Xid : 'xid_value'}
-    def __init__(self, typ, val, val_type):
+    # struct format of each cell kind, the pointer one depends on the target
+    type_formats = {Int : 'i', Oid : 'I', Xid : 'I'}
+    def __init__(self, typ, raw, val_type):
         self.value_type = typ
-        self.value = val[self.type_values[typ]]
-        if typ != self.ptr:
-            return
-        self.value = cast_Node(self.value) if \
-            val_type.name == 'Node' else self.value.cast(val_type.pointer())
+        self._raw = raw
+        self._val_type = val_type
+        self._value = None
+
+    @property
+    def value(self):
+        """The cell value, a gdb.Value is only built for pointer cells"""
+        if self.value_type != self.ptr:
+            return self._raw
+        if self._value is None:
+            ptr_type = self._val_type or types.lookup('void')
+            value = gdb.Value(self._raw).cast(ptr_type.pointer())
+            self._value = cast_Node(value) if \
+                ptr_type.name == 'Node' and self._raw else value
+        return self._value
+
     def to_string(self, cvar):
         if self.value_type != self.ptr:
             return self.value
@@ -187,9 +937,26 @@ class List:
         self._type = int(val['type'])
         self.type_name = ListCell.type_values[self._type]
         self.length = int(val["length"])
-        self._elements = val["elements"]
+        self._elements = int(val["elements"])
         self._index = 0
-        self._ptr_type = gdb.lookup_type(ptr_type_name) if ptr_type_name else None
+        self._ptr_type = types.lookup(ptr_type_name) if ptr_type_name else None
+        self._cells = None
+
+    def read_cells(self):
+        """Read the whole elements array with one memory read"""
+        if self.length == 0:
+            return []
+        cell_size = types.lookup('ListCell').sizeof
+        if self._type == ListCell.ptr:
+            ptr_size = types.lookup('void').pointer().sizeof
+            code = 'Q' if ptr_size == 8 else 'I'
+        else:
+            code = ListCell.type_formats[self._type]
+        pad = cell_size - struct.calcsize(code)
+        fmt = struct.Struct(f'{types.endian}{code}{pad}x')
+        buf = gdb.selected_inferior().read_memory(self._elements,
+                                                  cell_size * self.length)
+        return [v for v, in fmt.iter_unpack(memoryview(buf))]
 
     def __iter__(self):
         return self
@@ -197,13 +964,475 @@ class List:
     def __next__(self):
         if self._index >= self.length:
             raise StopIteration
-        cell = ListCell(self._type, self._elements[self._index], self._ptr_type)
+        if self._cells is None:
+            self._cells = self.read_cells()
+        cell = ListCell(self._type, self._cells[self._index], self._ptr_type)
         self._index += 1
         return cell
 
+def scalar_format(typ):
+    """Return the struct format character of a scalar type, None otherwise"""
+    typ = typ.strip_typedefs()
+    if typ.code == gdb.TYPE_CODE_PTR:
+        return 'Q' if typ.sizeof == 8 else 'I'
+    if typ.code == gdb.TYPE_CODE_FLT:
+        return 'd' if typ.sizeof == 8 else 'f'
+    if typ.code not in (gdb.TYPE_CODE_INT, gdb.TYPE_CODE_ENUM,
+                        gdb.TYPE_CODE_BOOL, gdb.TYPE_CODE_CHAR):
+        return None
+    code = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}[typ.sizeof]
+    try:
+        signed = typ.is_signed
+    except (AttributeError, ValueError):
+        # gdb before 12
+        signed = typ.code != gdb.TYPE_CODE_BOOL and \
+            not (typ.name or '').startswith(('unsigned', 'uint'))
+    return code if signed else code.upper()
+
+class StructLayout(object):
+    """Offsets and formats of some fields of a struct from the debug info
+
+    Decoding them from a raw memory read is much cheaper than a gdb.Value per
+    field when there are thousands of structs. A field is a dotted path into
+    nested structs, e.g. 'state.value'; a field this server version does not
+    have decodes as None.
+    """
+
+    def __init__(self, typ, fields):
+        typ = typ.strip_typedefs()
+        self.size = typ.sizeof
+        self.names = tuple(fields)
+        # name -> (offset, struct.Struct) of the fields found
+        self.fields = {}
+        for name in self.names:
+            found = self.find(typ, name)
+            if found is None:
+                continue
+            offset, ftype = found
+            code = scalar_format(ftype)
+            if code is None:
+                raise ValueError(f'{typ.tag}.{name} is not a scalar')
+            self.fields[name] = (offset, struct.Struct(types.endian + code))
+        # element size -> struct.Struct of a whole element
+        self._records = {}
+
+    @staticmethod
+    def find(typ, path):
+        """Return (offset, type) of the dotted PATH in TYP, None if missing"""
+        offset = 0
+        for name in path.split('.'):
+            for field in typ.fields():
+                if field.name == name:
+                    offset += field.bitpos // 8
+                    typ = field.type.strip_typedefs()
+                    break
+            else:
+                return None
+        return (offset, typ)
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def offset(self, name):
+        return self.fields[name][0]
+
+    def unpack(self, buf, base=0):
+        """Decode the fields of the struct at BASE in BUF as a dict"""
+        values = dict.fromkeys(self.names)
+        for name, (offset, fmt) in self.fields.items():
+            values[name] = fmt.unpack_from(buf, base + offset)[0]
+        return values
+
+    def read(self, address):
+        buf = gdb.selected_inferior().read_memory(address, self.size)
+        return self.unpack(buf)
+
+    def iter_unpack(self, buf, stride=None):
+        """Decode an array of structs STRIDE bytes apart, the struct size by
+        default, as tuples of the found fields in offset order. A single
+        struct.Struct covers a whole element, padding included."""
+        stride = stride or self.size
+        record = self._records.get(stride)
+        if record is None:
+            fmt, pos = types.endian, 0
+            for name, (offset, field) in sorted(self.fields.items(),
+                                                key=lambda f: f[1][0]):
+                if offset < pos:
+                    raise ValueError(f'{name} overlaps another field')
+                fmt += f'{offset - pos}x' + field.format[1:]
+                pos = offset + field.size
+            record = self._records[stride] = struct.Struct(fmt + f'{stride - pos}x')
+        usable = len(buf) - len(buf) % stride
+        return record.iter_unpack(memoryview(buf)[:usable])
+
+    def record_names(self):
+        """Names of the fields in the tuples of iter_unpack()"""
+        return [name for name, _ in sorted(self.fields.items(),
+                                           key=lambda f: f[1][0])]
+
+def field_offset(typ, path):
+    """Return the offset of the dotted PATH in struct TYP, None if missing"""
+    found = StructLayout.find(typ.strip_typedefs(), path)
+    return found[0] if found is not None else None
+
+def read_cstring(address, limit=1024):
+    """Read a NUL terminated string without crossing into an unmapped page"""
+    inferior = gdb.selected_inferior()
+    data = b''
+    while len(data) < limit:
+        size = min(limit - len(data), 4096 - address % 4096)
+        chunk = inferior.read_memory(address, size).tobytes()
+        end = chunk.find(b'\0')
+        if end >= 0:
+            data += chunk[:end]
+            break
+        data += chunk
+        address += size
+    return data[:limit].decode(errors='replace')
+
+def read_pointers(address, count):
+    """Read an array of COUNT pointers with one memory read"""
+    if count <= 0:
+        return []
+    size = types.lookup('void').pointer().sizeof
+    code = 'Q' if size == 8 else 'I'
+    buf = gdb.selected_inferior().read_memory(address, size * count)
+    return list(struct.unpack(f'{types.endian}{count}{code}', buf))
+
+class WindowReader(object):
+    """Read small structs through aligned windows of inferior memory
+
+    Following a linked list a node at a time costs a memory read per node.
+    Nodes allocated together share a window, read once and kept until
+    MAX_WINDOWS windows are cached.
+    """
+
+    def __init__(self, window=65536, max_windows=256):
+        self.window = window
+        self.max_windows = max_windows
+        self.windows = {}
+        self.inferior = gdb.selected_inferior()
+
+    def read(self, address, size):
+        """Return (buffer, offset of ADDRESS in it)"""
+        base = address - address % self.window
+        if address + size <= base + self.window:
+            buf = self.windows.get(base)
+            if buf is None:
+                if len(self.windows) >= self.max_windows:
+                    self.windows.clear()
+                try:
+                    buf = self.inferior.read_memory(base, self.window)
+                except gdb.MemoryError:
+                    # the window runs past the mapping
+                    buf = None
+                self.windows[base] = buf
+            if buf is not None:
+                return (buf, address - base)
+        return (self.inferior.read_memory(address, size), 0)
+
+class HashTable(object):
+    """Iterate over the entries of a dynahash HTAB from memory
+
+    The directory and each segment of buckets are read at once, the bucket
+    chains through a WindowReader as the elements are allocated in batches.
+    Iterating gives the addresses of the entries, which follow their
+    HASHELEMENT at a MAXALIGNed offset.
+    """
+
+    def __init__(self, htab):
+        htab = int(htab)
+        fields = types.layout('HTAB', ('hctl', 'dir', 'ssize', 'sshift',
+                                       'tabname')).read(htab)
+        self.hctl = fields['hctl']
+        self.dir = fields['dir']
+        self.tabname_ptr = fields['tabname']
+        hctl = types.layout('HASHHDR', ('max_bucket', 'nsegs', 'ssize', 'sshift',
+                                        'keysize', 'entrysize', 'nentries',
+                                        'num_partitions')).read(self.hctl)
+        self.max_bucket = hctl['max_bucket']
+        self.nsegs = hctl['nsegs']
+        # older versions keep the segment size in HASHHDR only
+        self.ssize = fields['ssize'] or hctl['ssize']
+        self.sshift = fields['sshift'] or hctl['sshift']
+        self.keysize = hctl['keysize']
+        self.entrysize = hctl['entrysize']
+        self.num_partitions = hctl['num_partitions']
+        self._nentries = hctl['nentries']
+        self.link = types.layout('HASHELEMENT', ('link',))
+        try:
+            align = int(gdb.parse_and_eval('MAXIMUM_ALIGNOF'))
+        except gdb.error:
+            align = 8
+        self.data_offset = (self.link.size + align - 1) // align * align
+        self.reader = WindowReader()
+
+    @property
+    def nbuckets(self):
+        return self.max_bucket + 1
+
+    @property
+    def nentries(self):
+        """The entry count of the header, summed over the free lists from 11 on"""
+        if self._nentries is None:
+            typ = types.lookup('HASHHDR').strip_typedefs()
+            free_lists = typ['freeList'].type
+            layout = types.layout('FreeListData', ('nentries',))
+            buf = gdb.selected_inferior().read_memory(
+                self.hctl + field_offset(typ, 'freeList'), free_lists.sizeof)
+            self._nentries = sum(n for n, in layout.iter_unpack(buf))
+        return self._nentries
+
+    @property
+    def tabname(self):
+        return read_cstring(self.tabname_ptr, 64) if self.tabname_ptr else None
+
+    def buckets(self):
+        """Yield the first element address of every bucket"""
+        segments = read_pointers(self.dir, min(self.nsegs,
+                                               -(-self.nbuckets // self.ssize)))
+        for number, segment in enumerate(segments):
+            count = min(self.ssize, self.nbuckets - number * self.ssize)
+            if segment:
+                yield from read_pointers(segment, count)
+            else:
+                yield from [0] * count
+
+    def chain(self, element):
+        """Yield the element addresses of the chain starting at ELEMENT"""
+        seen = set()
+        while element and element not in seen:
+            seen.add(element)
+            yield element
+            buf, offset = self.reader.read(element, self.link.size)
+            element = self.link.unpack(buf, offset)['link']
+
+    def __iter__(self):
+        for bucket in self.buckets():
+            for element in self.chain(bucket):
+                yield element + self.data_offset
+
+    def entries(self, typ):
+        """Yield the entries as pointers to TYP"""
+        pointer = typ.pointer()
+        for entry in self:
+            yield gdb.Value(entry).cast(pointer)
+
+    def chain_lengths(self):
+        """Return a Counter of chain length -> number of buckets"""
+        lengths = collections.Counter()
+        for bucket in self.buckets():
+            lengths[sum(1 for _ in self.chain(bucket))] += 1
+        return lengths
+
+    def summary(self, lengths=None):
+        name = f' "{self.tabname}"' if self.tabname_ptr else ''
+        text = f'HTAB{name} with {self.nentries} entries in ' \
+            f'{self.nbuckets} buckets, fill factor {self.nentries / self.nbuckets:.2f}'
+        if lengths:
+            text += f', longest chain {max(lengths)}'
+        return text
+
+def murmurhash32(data):
+    """The 32 bit finalizer of murmurhash3, common/hashfn.h"""
+    h = data & 0xffffffff
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+class SimpleHashTable(object):
+    """Scan the bucket array of a simplehash.h instantiation
+
+    The buckets are open addressed, an element is in use when its status
+    byte is SH_STATUS_IN_USE. They are read CHUNK elements at a time and the
+    status bytes taken with a stride slice. The probe distance of an element
+    needs its hash: a field storing it (SH_STORE_HASH), or a function of a
+    key field for instantiations which do not store it.
+    """
+
+    IN_USE = 1
+    # instantiation -> (key field, hash function of the key)
+    hash_keys = {'pagetable_hash': ('blockno', murmurhash32)}
+
+    def __init__(self, val, hash_field=None):
+        self.name = val.type.strip_typedefs().target().tag
+        fields = types.layout(self.name, ('size', 'members', 'sizemask',
+                                          'grow_threshold', 'data')).read(int(val))
+        self.size = fields['size']
+        self.members = fields['members']
+        self.sizemask = fields['sizemask']
+        self.data = fields['data']
+        element = val['data'].type.strip_typedefs().target().strip_typedefs()
+        self.element_size = element.sizeof
+        self.status_offset = field_offset(element, 'status')
+        self.hash_function = None
+        if hash_field is None:
+            if self.name in self.hash_keys:
+                hash_field, self.hash_function = self.hash_keys[self.name]
+            elif field_offset(element, 'hash') is not None:
+                hash_field = 'hash'
+        self.hash_field = hash_field
+        self.layout = types.layout(element.tag or element.name,
+                                   ('status', hash_field) if hash_field else ('status',))
+        if hash_field and hash_field not in self.layout:
+            raise gdb.GdbError(f'{element} has no field {hash_field}')
+
+    def chunks(self, chunk=65536):
+        """Yield (index of the first element, buffer) of the bucket array"""
+        inferior = gdb.selected_inferior()
+        for start in range(0, self.size, chunk):
+            count = min(chunk, self.size - start)
+            yield start, inferior.read_memory(self.data + start * self.element_size,
+                                              count * self.element_size)
+
+    def stats(self):
+        """Return a dict of the counters of the table"""
+        in_use = 0
+        statuses = bytearray()
+        max_probe = total_probe = 0
+        if self.hash_field:
+            # the hash is after the status or before it
+            hash_index = self.layout.record_names().index(self.hash_field)
+        for start, buf in self.chunks():
+            status = memoryview(buf)[self.status_offset::self.element_size].tobytes()
+            statuses += status
+            in_use += status.count(self.IN_USE)
+            if not self.hash_field:
+                continue
+            for index, record in enumerate(self.layout.iter_unpack(buf), start):
+                if record[1 - hash_index] != self.IN_USE:
+                    continue
+                hash_value = record[hash_index]
+                if self.hash_function is not None:
+                    hash_value = self.hash_function(hash_value)
+                distance = (index - hash_value) & self.sizemask
+                total_probe += distance
+                max_probe = max(max_probe, distance)
+        # runs of used buckets, the last one wraps around to the first
+        runs = [len(run) for run in bytes(statuses).split(bytes([0]))]
+        if len(runs) > 1:
+            runs[0] += runs.pop()
+        stats = {'size': self.size, 'members': self.members, 'in_use': in_use,
+                 'load_factor': self.members / self.size if self.size else 0.0,
+                 'longest_run': max(runs) if runs else 0}
+        if self.hash_field:
+            stats['max_probe'] = max_probe
+            stats['avg_probe'] = total_probe / in_use if in_use else 0.0
+        return stats
+
+def find_simplehash_types():
+    """Names of the simplehash instantiations in the debug info, found by
+    their name and checked by their fields"""
+    output = gdb.execute('info types _hash$', to_string=True)
+    names = sorted(set(re.findall(r'(\w+_hash);\s*$', output, re.MULTILINE)))
+    found = []
+    for name in names:
+        try:
+            typ = types.lookup(name).strip_typedefs()
+        except gdb.error:
+            continue
+        if typ.code == gdb.TYPE_CODE_STRUCT and all(
+                gdb.types.has_field(typ, f) for f in
+                ('size', 'members', 'sizemask', 'grow_threshold', 'data')):
+            found.append(name)
+    return found
+
+class DsaArea(object):
+    """Translate dsa_pointers of a dsa_area attached by the inferior"""
+
+    def __init__(self, area):
+        self.area = int(area)
+        typ = types.lookup('dsa_area').strip_typedefs()
+        self.maps = self.area + field_offset(typ, 'segment_maps')
+        self.map_layout = types.layout('dsa_segment_map', ('mapped_address',))
+        pointer_size = types.lookup('dsa_pointer').sizeof
+        try:
+            self.offset_width = int(gdb.parse_and_eval('DSA_OFFSET_WIDTH'))
+        except gdb.error:
+            # the values of utils/dsa.h
+            self.offset_width = 40 if pointer_size == 8 else 27
+        self.segments = {}
+
+    def address(self, dp):
+        """The address of dsa_pointer DP, as dsa_get_address() computes it"""
+        if not dp:
+            return 0
+        index = dp >> self.offset_width
+        base = self.segments.get(index)
+        if base is None:
+            base = self.segments[index] = self.map_layout.read(
+                self.maps + index * self.map_layout.size)['mapped_address']
+        if not base:
+            raise gdb.GdbError(f'DSA segment {index} is not mapped in this backend')
+        return base + (dp & ((1 << self.offset_width) - 1))
+
+class DshashTable(object):
+    """Walk the partitions and bucket chains of a dshash table"""
+
+    def __init__(self, val):
+        table = types.layout('dshash_table', ('area', 'control')).read(int(val))
+        self.area = DsaArea(table['area'])
+        self.control = table['control']
+        typ = types.lookup('dshash_table_control').strip_typedefs()
+        control = types.layout('dshash_table_control',
+                               ('size_log2', 'buckets')).read(self.control)
+        self.size_log2 = control['size_log2']
+        self.buckets = control['buckets']
+        partitions = typ['partitions'].type
+        self.partition_layout = types.layout('dshash_partition', ('count',))
+        self.npartitions = partitions.sizeof // self.partition_layout.size
+        self.partitions_offset = field_offset(typ, 'partitions')
+        self.item = types.layout('struct dshash_table_item', ('next',))
+        self.reader = WindowReader()
+
+    def partition_counts(self):
+        buf = gdb.selected_inferior().read_memory(
+            self.control + self.partitions_offset,
+            self.npartitions * self.partition_layout.size)
+        return [count for count, in self.partition_layout.iter_unpack(buf)]
+
+    def chain_lengths(self):
+        """Return the chain length of every bucket"""
+        nbuckets = 1 << self.size_log2
+        size = types.lookup('dsa_pointer').sizeof
+        code = 'Q' if size == 8 else 'I'
+        buf = gdb.selected_inferior().read_memory(self.area.address(self.buckets),
+                                                  nbuckets * size)
+        lengths = []
+        for dp in struct.unpack(f'{types.endian}{nbuckets}{code}', buf):
+            length = 0
+            seen = set()
+            while dp and dp not in seen:
+                seen.add(dp)
+                length += 1
+                item, offset = self.reader.read(self.area.address(dp), self.item.size)
+                dp = self.item.unpack(item, offset)['next']
+            lengths.append(length)
+        return lengths
+
+    def stats(self):
+        counts = self.partition_counts()
+        lengths = self.chain_lengths()
+        members = sum(counts)
+        return {'size': len(lengths), 'members': members,
+                'load_factor': members / len(lengths) if lengths else 0.0,
+                'max_chain': max(lengths, default=0),
+                'partitions': len(counts),
+                'min_partition': min(counts, default=0),
+                'max_partition': max(counts, default=0)}
+
 class ExprTraverser(gdb.Command, TreeWalker):
     def __init__ (self):
         super(self.__class__, self).__init__ ("pg expr", gdb.COMMAND_DATA)
+        TreeWalker.__init__(self)
+        # (path, mtime) of the loaded $expr_display file
+        self.display_config = None
+        self.fields = self.display_fields
+        # type name -> accessors of its display properties
+        self.display_specs = {}
 
     def walk_List(self, val):
         children = []
@@ -214,69 +1443,438 @@ class ExprTraverser(gdb.Command, TreeWalker):
         return self.walk_List(val['args']) if gdb.types.has_field(val.type.target(), 'args') else []
     def walk_(self, val):
         return self._walk_to_args(val)
-    def show_(self, val):
-        # Display properties for each struct, can define as single string if
-        # only 1 property needs to display. if a property name includes ':',
-        # a property value can be appended after ':'. It will be hided if
-        # the property value does not equal to the value.
-        display_fields = {
-            'Const' : ('constisnull:true', 'consttype', 'constvalue'),
-            'Var' : ('varno', 'varattno', 'vartype'),
-            'BoolExpr' : 'boolop',
-            'OpExpr' : 'opno',
-            'ScalarArrayOpExpr' : 'opno',
-            'FuncExpr' : ('funcid', 'funcresulttype')
-            }
-        typname = val.dereference().type.name
-        def prop_str(prop):
+    # Display properties for each struct, can define as single string if
+    # only 1 property needs to display. if a property name includes ':',
+    # a property value can be appended after ':'. It will be hided if
+    # the property value does not equal to the value. More can be set in
+    # the JSON file named by $expr_display, in the same format.
+    display_fields = {
+        'Const' : ('constisnull:true', 'consttype', 'constvalue'),
+        'Var' : ('varno', 'varattno', 'vartype'),
+        'BoolExpr' : 'boolop',
+        'OpExpr' : 'opno',
+        'ScalarArrayOpExpr' : 'opno',
+        'FuncExpr' : ('funcid', 'funcresulttype')
+        }
+
+    def load_display_config(self):
+        """Merge the $expr_display file into the display properties.
+
+        The file is read again only when it changes.
+        """
+        config = gdb.convenience_variable('expr_display')
+        path = os.path.expanduser(config.string()) if config is not None else None
+        mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+        if (path, mtime) == self.display_config:
+            return
+        fields = dict(self.display_fields)
+        if mtime is not None:
+            with open(path) as f:
+                fields.update(json.load(f))
+        self.fields = fields
+        self.display_config = (path, mtime)
+        self.display_specs = {}
+
+    @staticmethod
+    def compile_display(typname, props):
+        """Return one accessor per property, each reads its field once"""
+        if isinstance(props, str):
+            props = (props,)
+        accessors = []
+        for prop in props:
+            disp_val = None
             if ':' in prop:
                 prop, disp_val = prop.split(':')
-                if disp_val != str(val[prop]):
-                    return ''
             name = prop[len(typname):] if prop.startswith(typname.lower()) else prop
-            return f'{name} = {val[prop]}'
-        if typname not in display_fields:
+            def accessor(val, prop=prop, name=name, disp_val=disp_val):
+                value = val[prop]
+                if disp_val is None:
+                    return (name, value)
+                return (name, disp_val) if str(value) == disp_val else None
+            accessors.append(accessor)
+        return accessors
+
+    def show_(self, val):
+        typname = val.type.target().name
+        accessors = self.display_specs.get(typname)
+        if accessors is None:
+            accessors = self.compile_display(typname, self.fields.get(typname, ()))
+            self.display_specs[typname] = accessors
+        if not accessors:
             return ''
-        prop = display_fields[typname]
-        return prop_str(prop) if isinstance(prop, str) else \
-            ', '.join([prop_str(p) for p in prop if prop_str(p)])
+        return [f for f in (accessor(val) for accessor in accessors) if f is not None]
+
+    def walk_key(self, expr, args):
+        return super().walk_key(expr, args) + (self.display_config,)
 
     def invoke(self, arg, from_tty):
         if not arg:
-            print("usage: pg expr [expr]")
+            print("usage: pg expr [--max-depth N] [--format text|json|dot] "
+                  "[--limit N] [--offset N] [--output FILE] [expr]")
             return
-        expr = gdb.parse_and_eval(arg)
-        self.walk(expr)
+        args = self.parse_args('pg expr', arg)
+        self.load_display_config()
+        expr = gdb.parse_and_eval(args.expr)
+        self.walk(expr, self.walk_key(expr, args))
 ExprTraverser()
 
 class PlanTraverser(gdb.Command, TreeWalker):
     def __init__ (self):
         super(self.__class__, self).__init__ ("pg plan", gdb.COMMAND_DATA)
+        TreeWalker.__init__(self)
+        self.collapse = None
+        self.sort_by = None
+        self.top = 10
+        # range table entries of the walked statement and their fields, and
+        # the address of the --rtable List
+        self.rtable = None
+        self.rtable_address = None
+        self.rte_cache = {}
+        # Plan subtype name -> whether it is a Scan
+        self.scan_types = {}
+        # Plan subtype name -> (Plan pointer fields, List of Plans fields)
+        self.child_table = None
+        # PlannedStmt->subplans of the walked statement, for initPlans
+        self.subplans = None
+        gdb.events.new_objfile.connect(self.drop_child_table)
+        gdb.events.clear_objfiles.connect(self.drop_child_table)
 
-    def walk_(self, val):
+    def drop_child_table(self, event=None):
+        self.child_table = None
+
+    def build_child_table(self):
+        """Find the fields of each Plan subtype holding child plans.
+
+        Every NodeTag whose struct starts with a Plan, directly or through
+        Scan, Join etc, gets its pointers to Plan structs and its List fields
+        named '*plans' (appendplans, bitmapplans, custom_plans ...), including
+        those of its base structs. Lists cannot tell their element type in
+        the debug info, hence the name. Each field comes with the pointer
+        type of the struct declaring it, as C only looks up direct members.
+        """
+        def base_struct(typ):
+            fields = typ.fields()
+            if not fields:
+                return None
+            first = fields[0].type.strip_typedefs()
+            return first if first.code == gdb.TYPE_CODE_STRUCT else None
+        def is_plan(typ):
+            while typ is not None:
+                if typ.tag == 'Plan':
+                    return True
+                typ = base_struct(typ)
+            return False
+        def child_fields(typ):
+            pointers, lists = [], []
+            while typ is not None:
+                base = base_struct(typ)
+                fields = typ.fields()[1 if base is not None else 0:]
+                for field in fields:
+                    ftype = field.type.strip_typedefs()
+                    if ftype.code != gdb.TYPE_CODE_PTR:
+                        continue
+                    target = ftype.target().strip_typedefs()
+                    if target.code != gdb.TYPE_CODE_STRUCT:
+                        continue
+                    if target.tag == 'List' and field.name.endswith('plans'):
+                        lists.append((typ.pointer(), field.name))
+                    elif is_plan(target):
+                        pointers.append((typ.pointer(), field.name))
+                typ = base
+            return (pointers, lists)
+        table = {}
+        for tag in types.lookup('NodeTag').strip_typedefs().fields():
+            try:
+                typ = types.lookup(tag.name[2:]).strip_typedefs()
+            except gdb.error:
+                continue
+            if typ.code == gdb.TYPE_CODE_STRUCT and is_plan(typ):
+                table[tag.name[2:]] = child_fields(typ)
+        return table
+
+    def summary(self, field, plans):
+        counts = collections.Counter(types.node_type(p).name for p in plans)
+        kinds = ', '.join(f'{n} {name}' for name, n in counts.most_common())
+        return f'... {len(plans)} {field}: {kinds}'
+
+    def walk_PlannedStmt(self, val):
+        if self.rtable is None and val['rtable']:
+            self.rtable = [c.value for c in List(val['rtable'], 'RangeTblEntry')]
+        self.subplans = [c.value for c in List(val['subplans'], 'Node')] \
+            if val['subplans'] else []
+        children = [cast_Node(val['planTree'])] if val['planTree'] else []
+        # subplans not reached as initPlans are shown after the plan tree
+        init_ids = self.init_plan_ids(children + [p for p in self.subplans if p])
+        return children + [p for i, p in enumerate(self.subplans, 1)
+                           if p and i not in init_ids]
+
+    def init_plans(self, val):
+        """Return the plan_ids of the initPlans attached to plan VAL"""
+        plan = val.cast(types.lookup('Plan').pointer())
+        if not plan['initPlan']:
+            return []
+        return [int(s.value['plan_id']) for s in List(plan['initPlan'], 'SubPlan')]
+
+    def child_plans(self, val):
+        """Return the plans VAL points to and the (field, plans) of its lists"""
+        if self.child_table is None:
+            self.child_table = self.build_child_table()
+        pointers, lists = self.child_table.get(val.type.target().name, ((), ()))
         children = []
-        typ = gdb.lookup_type('Plan')
-        plan = val.cast(typ.pointer())
-        for field in ('lefttree', 'righttree'):
-            if plan[field]:
-                child = plan[field]
+        for owner, field in pointers:
+            child = val.cast(owner)[field]
+            if child:
                 children.append(cast_Node(child))
+        plan_lists = []
+        for owner, field in lists:
+            child = val.cast(owner)[field]
+            if child:
+                plan_lists.append((field, [c.value for c in List(child, 'Node')]))
+        return children, plan_lists
+
+    def init_plan_ids(self, roots):
+        """Return the plan_ids of the initPlans found from the plans ROOTS"""
+        plan_ids, seen = set(), set()
+        stack = list(roots)
+        while stack:
+            val = stack.pop()
+            if int(val) in seen or not self.is_plan(val.type.target().name):
+                continue
+            seen.add(int(val))
+            plan_ids.update(self.init_plans(val))
+            children, plan_lists = self.child_plans(val)
+            stack += children
+            for _, plans in plan_lists:
+                stack += plans
+        return plan_ids
+
+    def walk_(self, val):
+        children = []
+        for plan_id in self.init_plans(val):
+            if self.subplans is None:
+                children.append(f'initPlan {plan_id} (walk the PlannedStmt to expand it)')
+            elif 0 < plan_id <= len(self.subplans) and self.subplans[plan_id - 1]:
+                children.append(self.subplans[plan_id - 1])
+        pointers, plan_lists = self.child_plans(val)
+        children += pointers
+        for field, plans in plan_lists:
+            if self.collapse is not None and len(plans) > self.collapse:
+                children.append(self.summary(field, plans))
+            else:
+                children += plans
         return children
 
+    def rte_fields(self, rti):
+        """Return the relation OID and the alias of range table entry RTI.
+
+        The alias is eref->aliasname, the relation name unless the query
+        gives another; the name itself is only known to the catalogs.
+        """
+        if not self.rtable or not 0 < rti <= len(self.rtable):
+            return []
+        fields = self.rte_cache.get(rti)
+        if fields is None:
+            rte = self.rtable[rti - 1]
+            fields = [('relid', int(rte['relid']))] if int(rte['relid']) else []
+            if rte['eref']:
+                fields.append(('alias', rte['eref']['aliasname'].string()))
+            self.rte_cache[rti] = fields
+        return fields
+
     def show_scan(self, val):
-        relid = val['scan']['scanrelid']
-        return f'scanrelid={relid}'
+        relid = int(val['scan']['scanrelid'])
+        return [('scanrelid', relid)] + self.rte_fields(relid)
+
+    def is_plan(self, typname):
+        if self.child_table is None:
+            self.child_table = self.build_child_table()
+        return typname in self.child_table
+
+    def show_(self, val):
+        # other nodes of the tree, such as the PlannedStmt, are not Plans
+        if not self.is_plan(val.type.target().name):
+            return ''
+        plan = val.cast(types.lookup('Plan').pointer())
+        fields = [('startup_cost', f"{float(plan['startup_cost']):.2f}"),
+                  ('total_cost', f"{float(plan['total_cost']):.2f}"),
+                  ('plan_rows', f"{float(plan['plan_rows']):.0f}"),
+                  ('plan_width', int(plan['plan_width'])),
+                  ('parallel_aware', 'true' if plan['parallel_aware'] else 'false')]
+        typname = val.type.target().name
+        is_scan = self.scan_types.get(typname)
+        if is_scan is None:
+            is_scan = self.scan_types[typname] = \
+                gdb.types.has_field(val.type.target(), 'scan')
+        if is_scan:
+            fields += self.show_scan(val)
+        return fields
 
-    show_SeqScan = show_scan
+    def render_summary(self, nodes):
+        """List the --top nodes by --sort-by instead of the tree"""
+        def cost(node):
+            return float(node['fields']['total_cost'])
+        rows = []
+        for node in nodes:
+            if not self.is_plan(node.get('tag')) or 'fields' not in node:
+                continue
+            children = [nodes[c] for c in node['children']]
+            self_cost = cost(node) - sum(cost(c) for c in children
+                                         if 'total_cost' in c.get('fields', ()))
+            rows.append((node, self_cost))
+        sort_keys = {'cost' : lambda r: cost(r[0]),
+                     'self-cost' : lambda r: r[1],
+                     'rows' : lambda r: float(r[0]['fields']['plan_rows'])}
+        rows.sort(key=sort_keys[self.sort_by], reverse=True)
+        self.emit(f"{'node':<8} {'total_cost':>12} {'self_cost':>12} {'rows':>10}  type")
+        for node, self_cost in rows[:self.top]:
+            fields = node['fields']
+            alias = f" on {fields['alias']}" if 'alias' in fields else ''
+            self.emit(f"{node['cvar'] or node['address']:<8} {fields['total_cost']:>12} "
+                      f"{self_cost:>12.2f} {fields['plan_rows']:>10}  {node['tag']}{alias}")
+
+    def render(self, nodes):
+        if self.sort_by:
+            self.render_summary(nodes)
+        else:
+            super().render(nodes)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--collapse', type=int, default=None,
+                            help='summarize child plan lists longer than this')
+        parser.add_argument('--rtable', help='range table List to name relations from')
+        parser.add_argument('--sort-by', choices=('cost', 'self-cost', 'rows'),
+                            help='list the most expensive nodes instead of the tree')
+        parser.add_argument('--top', type=int, default=10,
+                            help='number of nodes listed by --sort-by')
+
+    def walk_key(self, expr, args):
+        return super().walk_key(expr, args) + (args.collapse, self.rtable_address)
 
     def invoke(self, arg, from_tty):
         if not arg:
-            print("usage: pg plan [plan]")
+            print("usage: pg plan [--max-depth N] [--collapse N] [--rtable LIST] "
+                  "[--sort-by cost|self-cost|rows [--top N]] [--format text|json|dot] "
+                  "[--limit N] [--offset N] [--output FILE] [plan]")
             return
-        plan = gdb.parse_and_eval(arg)
-        self.walk(cast_Node(plan))
+        args = self.parse_args('pg plan', arg)
+        self.collapse = args.collapse
+        self.sort_by = args.sort_by
+        self.top = args.top
+        self.subplans = None
+        self.rte_cache = {}
+        self.rtable = None
+        self.rtable_address = None
+        if args.rtable:
+            rtable = gdb.parse_and_eval(args.rtable)
+            self.rtable_address = int(rtable)
+            self.rtable = [c.value for c in List(rtable, 'RangeTblEntry')] if rtable else []
+        plan = cast_Node(gdb.parse_and_eval(args.expr))
+        self.walk(plan, self.walk_key(plan, args))
 PlanTraverser()
 
+def instr_time_seconds(val):
+    """Convert an instr_time, ticks in ns since PG16, a timespec before"""
+    if gdb.types.has_field(val.type, 'ticks'):
+        return int(val['ticks']) / 1e9
+    return int(val['tv_sec']) + int(val['tv_nsec']) / 1e9
+
+class PlanStateTraverser(gdb.Command, TreeWalker):
+    """dump the executor state tree of a running query with its instrumentation
+usage: pg planstate [--max-depth N] [--format text|json|dot] [--limit N]
+                    [--offset N] [--output FILE] [planstate]
+planstate defaults to ActivePortal->queryDesc->planstate. Times and counts
+include the loop in progress; nodes show 'instrument = none' unless the
+query runs with instrumentation, e.g. under EXPLAIN ANALYZE or auto_explain."""
+
+    default_expr = 'ActivePortal->queryDesc->planstate'
+    # node type -> (array of child PlanStates, its length)
+    child_arrays = {
+        'AppendState' : ('appendplans', 'as_nplans'),
+        'MergeAppendState' : ('mergeplans', 'ms_nplans'),
+        'BitmapAndState' : ('bitmapplans', 'nplans'),
+        'BitmapOrState' : ('bitmapplans', 'nplans'),
+        'ModifyTableState' : ('mt_plans', 'mt_nplans'),
+        }
+    # node type -> field pointing to a child PlanState
+    child_fields = {'SubqueryScanState' : 'subplan'}
+    # node type -> List of child PlanStates
+    child_lists = {'CustomScanState' : 'custom_ps'}
+    buffer_fields = ('shared_blks_hit', 'shared_blks_read', 'shared_blks_dirtied',
+                     'shared_blks_written', 'temp_blks_read', 'temp_blks_written')
+
+    def __init__ (self):
+        super(self.__class__, self).__init__ ("pg planstate", gdb.COMMAND_DATA)
+        TreeWalker.__init__(self)
+
+    def walk_(self, val):
+        ps = val.cast(types.lookup('PlanState').pointer())
+        children = []
+        for field in ('initPlan', 'subPlan'):
+            if ps[field]:
+                for subplan in List(ps[field], 'SubPlanState'):
+                    if subplan.value['planstate']:
+                        children.append(cast_Node(subplan.value['planstate']))
+        for field in ('lefttree', 'righttree'):
+            if ps[field]:
+                children.append(cast_Node(ps[field]))
+        typ = val.type.target()
+        typname = typ.name
+        if typname in self.child_arrays:
+            array, length = self.child_arrays[typname]
+            if gdb.types.has_field(typ, array):
+                children += [cast_Node(val[array][i]) for i in range(int(val[length]))]
+        if typname in self.child_fields and val[self.child_fields[typname]]:
+            children.append(cast_Node(val[self.child_fields[typname]]))
+        if typname in self.child_lists and val[self.child_lists[typname]]:
+            children += [c.value for c in List(val[self.child_lists[typname]], 'Node')]
+        return children
+
+    def show_(self, val):
+        ps = val.cast(types.lookup('PlanState').pointer())
+        fields = []
+        if ps['plan']:
+            fields.append(('plan_rows', ps['plan']['plan_rows']))
+        instr = ps['instrument']
+        if not instr:
+            fields.append(('instrument', 'none'))
+            return fields
+        instr = instr.dereference()
+        # the counters of the loop in progress are not added up yet
+        running = bool(instr['running'])
+        tuples = float(instr['ntuples']) + float(instr['tuplecount'])
+        loops = float(instr['nloops']) + (1 if running else 0)
+        startup = float(instr['startup']) + (float(instr['firsttuple']) if running else 0)
+        total = float(instr['total']) + instr_time_seconds(instr['counter'])
+        fields += [('tuples', f'{tuples:.0f}'), ('loops', f'{loops:.0f}'),
+                   ('startup_ms', f'{startup * 1000:.3f}'),
+                   ('total_ms', f'{total * 1000:.3f}')]
+        bufusage = instr['bufusage']
+        for field in self.buffer_fields:
+            count = int(bufusage[field])
+            if count:
+                fields.append((field, count))
+        return fields
+
+    def invoke(self, arg, from_tty):
+        args = self.parse_args('pg planstate', arg, self.default_expr)
+        try:
+            if args.expr == self.default_expr:
+                # NULL on an idle backend, following them would fault
+                portal = gdb.parse_and_eval('ActivePortal')
+                if not portal or not portal['queryDesc']:
+                    gdb.write("no query running\n")
+                    return
+            planstate = gdb.parse_and_eval(args.expr)
+        except gdb.error as e:
+            gdb.write(f"{args.expr}: {e}\n")
+            return
+        if not planstate:
+            gdb.write(f"{args.expr} is NULL\n")
+            return
+        planstate = cast_Node(planstate)
+        self.walk(planstate, self.walk_key(planstate, args))
+PlanStateTraverser()
+
 class NodeCastPrinter(gdb.Command):
     def __init__ (self):
         super(self.__class__, self).__init__ ("pg node", gdb.COMMAND_DATA)
@@ -290,6 +1888,913 @@ class NodeCastPrinter(gdb.Command):
         print(f'{cname} ({val.type})', val)
 NodeCastPrinter()
 
+class CoreReport(gdb.Command):
+    """write the stack and the output of some commands as JSON
+usage: pg report [-o FILE] [-x SCRIPT]
+SCRIPT has one gdb command per line, lines starting with '#' are ignored.
+It defaults to printing debug_query_string and the plan of ActivePortal.
+This is what pgcore.py runs for each core file."""
+
+    default_commands = ('p debug_query_string',
+                        'pg plan ActivePortal->queryDesc->plannedstmt->planTree')
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg report", gdb.COMMAND_DATA)
+
+    def stack(self):
+        frames = []
+        for frame, (function, filename, line) in symbols.unwind():
+            frames.append({'function': function, 'file': filename,
+                           'line': line, 'pc': frame.pc()})
+        return frames
+
+    def signal(self):
+        try:
+            signo = int(gdb.parse_and_eval('$_siginfo.si_signo'))
+        except gdb.error:
+            return None
+        try:
+            return signal.Signals(signo).name
+        except ValueError:
+            return str(signo)
+
+    def executor_node(self):
+        """Return the type of the innermost PlanState an executor frame works on"""
+        frame = gdb.newest_frame()
+        while frame is not None:
+            for name in ('pstate', 'node'):
+                try:
+                    val = frame.read_var(name)
+                    target = val.type.strip_typedefs().target()
+                    if target.name and target.name.endswith('State') and int(val):
+                        return types.node_type(val).name
+                except (ValueError, RuntimeError):
+                    # no such variable, optimized out or not a pointer
+                    continue
+            frame = frame.older()
+        return None
+
+    def plan_root(self):
+        try:
+            plan = gdb.parse_and_eval('ActivePortal->queryDesc->plannedstmt->planTree')
+            return types.node_type(plan).name if int(plan) else None
+        except gdb.error:
+            return None
+
+    def query(self, size=1024):
+        try:
+            query = gdb.parse_and_eval('debug_query_string')
+            return query.string()[:size] if int(query) else None
+        except (gdb.error, UnicodeDecodeError):
+            return None
+
+    def run_command(self, command):
+        try:
+            return {'command': command, 'output': gdb.execute(command, to_string=True)}
+        except gdb.error as e:
+            return {'command': command, 'error': str(e)}
+
+    def invoke(self, arg, from_tty):
+        parser = argparse.ArgumentParser(prog='pg report')
+        parser.add_argument('-o', '--output', help='write the report to this file')
+        parser.add_argument('-x', '--script', help='file of commands to run')
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        commands = self.default_commands
+        if args.script:
+            with open(os.path.expanduser(args.script)) as f:
+                commands = [line.strip() for line in f
+                            if line.strip() and not line.lstrip().startswith('#')]
+        report = {'signal': self.signal(), 'stack': [], 'executor_node': None,
+                  'plan_root': self.plan_root(), 'query': self.query(),
+                  'commands': [self.run_command(c) for c in commands]}
+        try:
+            report['stack'] = self.stack()
+            report['executor_node'] = self.executor_node()
+        except gdb.error as e:
+            report['error'] = str(e)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            with open(os.path.expanduser(args.output), 'w') as f:
+                f.write(text)
+        else:
+            gdb.write(text + '\n')
+CoreReport()
+
+class MemoryContextTree(gdb.Command):
+    """show the memory context tree without running code in the inferior
+usage: pg memctx [--min-bytes N] [--allocated] [context]
+As MemoryContextStats() does, the size of AllocSet, Generation, Slab and Bump
+contexts is summed from their block lists; --allocated, or a context type
+not known here, uses the mem_allocated counter instead. Children are sorted
+by the total of their subtree, subtrees below --min-bytes are summarized.
+context defaults to TopMemoryContext, this works on cores too."""
+
+    header_fields = ('type', 'firstchild', 'nextchild', 'name', 'ident',
+                     'mem_allocated')
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg memctx", gdb.COMMAND_DATA)
+        # NodeTag value -> name of the context struct
+        self.context_types = None
+        # bytes read at once from each context, enough for any context type
+        self.read_size = None
+        # address -> string of the context names and idents of one run
+        self.strings = {}
+        gdb.events.new_objfile.connect(self.drop_context_types)
+        gdb.events.clear_objfiles.connect(self.drop_context_types)
+
+    def drop_context_types(self, event=None):
+        self.context_types = None
+
+    def find_context_types(self):
+        """The NodeTags whose struct starts with a MemoryContextData"""
+        self.context_types = {}
+        self.read_size = types.lookup('MemoryContextData').sizeof
+        for tag in types.lookup('NodeTag').strip_typedefs().fields():
+            try:
+                typ = types.lookup(tag.name[2:]).strip_typedefs()
+            except gdb.error:
+                continue
+            fields = typ.fields() if typ.code == gdb.TYPE_CODE_STRUCT else ()
+            if fields and fields[0].type.strip_typedefs().tag == 'MemoryContextData':
+                self.context_types[tag.enumval] = tag.name[2:]
+                self.read_size = max(self.read_size, typ.sizeof)
+
+    def string(self, address, limit=100):
+        if not address:
+            return None
+        value = self.strings.get(address)
+        if value is None:
+            value = self.strings[address] = read_cstring(address, limit)
+        return value
+
+    def context_struct(self, name, fields, address, buf):
+        """Decode FIELDS of context struct NAME, from BUF if it holds it all"""
+        layout = types.layout(name, fields)
+        if len(buf) >= layout.size:
+            return layout.unpack(buf)
+        return layout.read(address)
+
+    def chain_blocks(self, block, layout, size):
+        """Count the blocks of a list linked through their 'next' field"""
+        nblocks = total = 0
+        seen = set()
+        while block and block not in seen:
+            seen.add(block)
+            fields = layout.read(block)
+            nblocks += 1
+            total += size(block, fields)
+            block = fields['next']
+        return (nblocks, total)
+
+    def dlist_blocks(self, head, layout, size):
+        """Count the blocks of a dlist whose nodes are their 'node' field"""
+        node_offset = layout.offset('node.next') - \
+            field_offset(types.lookup('dlist_node'), 'next')
+        node_layout = types.layout('dlist_node', ('next',))
+        node = node_layout.read(head)['next']
+        nblocks = total = 0
+        seen = set()
+        # a NULL next is a zeroed, never initialized, empty head
+        while node and node != head and node not in seen:
+            seen.add(node)
+            block = node - node_offset
+            fields = layout.read(block)
+            nblocks += 1
+            total += size(block, fields)
+            node = fields['node.next']
+        return (nblocks, total)
+
+    @staticmethod
+    def block_end(block, fields):
+        return fields['endptr'] - block
+
+    def blocks_AllocSetContext(self, address, buf):
+        ctx = self.context_struct('AllocSetContext', ('blocks',), address, buf)
+        layout = types.layout('AllocBlockData', ('next', 'endptr'))
+        return self.chain_blocks(ctx['blocks'], layout, self.block_end)
+
+    def blocks_GenerationContext(self, address, buf):
+        head = address + field_offset(types.lookup('GenerationContext'), 'blocks')
+        layout = types.layout('GenerationBlock', ('node.next', 'blksize', 'endptr'))
+        # blksize appeared in 14, it also counts a dedicated block's chunk
+        size = (lambda block, fields: fields['blksize']) \
+            if 'blksize' in layout else self.block_end
+        return self.dlist_blocks(head, layout, size)
+
+    def blocks_BumpContext(self, address, buf):
+        head = address + field_offset(types.lookup('BumpContext'), 'blocks')
+        layout = types.layout('BumpBlock', ('node.next', 'endptr'))
+        return self.dlist_blocks(head, layout, self.block_end)
+
+    def blocks_SlabContext(self, address, buf):
+        typ = types.lookup('SlabContext')
+        ctx = self.context_struct('SlabContext', ('blockSize', 'nblocks',
+                                                  'emptyblocks.count'), address, buf)
+        nblocks = ctx['nblocks']
+        if nblocks is None:
+            # 16 and later keep the empty blocks apart and no block count
+            nblocks = ctx['emptyblocks.count']
+            head_size = types.lookup('dlist_head').sizeof
+            lists = typ.strip_typedefs()['blocklist'].type.sizeof // head_size
+            offset = field_offset(typ, 'blocklist')
+            layout = types.layout('SlabBlock', ('node.next',))
+            for i in range(lists):
+                count, _ = self.dlist_blocks(address + offset + i * head_size,
+                                             layout, lambda block, fields: 0)
+                nblocks += count
+        return (nblocks, nblocks * ctx['blockSize'])
+
+    def collect(self, root, allocated):
+        """Return the contexts under ROOT in preorder as lists of
+        [address, name, ident, type, bytes, blocks, parent index, children]"""
+        if self.context_types is None:
+            self.find_context_types()
+        self.strings = {}
+        header = types.layout('MemoryContextData', self.header_fields)
+        inferior = gdb.selected_inferior()
+        contexts = []
+        seen = set()
+        stack = [(root, None)]
+        while stack:
+            address, parent = stack.pop()
+            if address in seen:
+                continue
+            seen.add(address)
+            try:
+                buf = inferior.read_memory(address, self.read_size)
+            except gdb.MemoryError:
+                # the largest context type may run past the mapping
+                buf = inferior.read_memory(address, header.size)
+            ctx = header.unpack(buf)
+            typname = self.context_types.get(ctx['type'], '?')
+            blocks = None
+            method = getattr(self, 'blocks_' + typname, None)
+            if method is not None and not allocated:
+                try:
+                    blocks = method(address, buf)
+                except (gdb.error, KeyError, TypeError):
+                    # this version lacks the struct or the fields used
+                    blocks = None
+            if blocks is None:
+                blocks = (None, ctx['mem_allocated'] or 0)
+            index = len(contexts)
+            contexts.append([address, self.string(ctx['name']) or '?',
+                             self.string(ctx['ident']), typname, blocks[1],
+                             blocks[0], parent, []])
+            if parent is not None:
+                contexts[parent][7].append(index)
+            if ctx['nextchild']:
+                stack.append((ctx['nextchild'], parent))
+            if ctx['firstchild']:
+                stack.append((ctx['firstchild'], index))
+        return contexts
+
+    def format_tree(self, contexts, min_bytes):
+        totals = [c[4] for c in contexts]
+        # children come after their parent in preorder
+        for index in range(len(contexts) - 1, 0, -1):
+            parent = contexts[index][6]
+            if parent is not None:
+                totals[parent] += totals[index]
+        lines = []
+        stack = [(0, 0)]
+        while stack:
+            index, depth = stack.pop()
+            if isinstance(index, tuple):
+                count, total = index
+                lines.append(f"{'  ' * depth}{count} more child contexts: "
+                             f"{total} total")
+                continue
+            address, name, ident, typname, size, nblocks, _, children = contexts[index]
+            label = f'{name}: {ident}' if ident else name
+            blocks = f'in {nblocks} blocks' if nblocks is not None else 'allocated'
+            line = f"{'  ' * depth}{label}: {totals[index]} total"
+            if children:
+                line += f'; {size} own {blocks}'
+            else:
+                line += f' {blocks}'
+            lines.append(f"{line} ({typname.replace('Context', '')} {address:#x})")
+            shown = sorted((c for c in children if totals[c] >= min_bytes),
+                           key=lambda c: totals[c])
+            hidden = [totals[c] for c in children if totals[c] < min_bytes]
+            if hidden:
+                stack.append(((len(hidden), sum(hidden)), depth + 1))
+            stack.extend((c, depth + 1) for c in shown)
+        counted = [c[5] for c in contexts if c[5] is not None]
+        blocks = f' in {sum(counted)} blocks' if counted else ''
+        lines.append(f'Grand total: {totals[0]} bytes{blocks}; {len(contexts)} contexts')
+        return lines
+
+    def invoke(self, arg, from_tty):
+        parser = argparse.ArgumentParser(prog='pg memctx')
+        parser.add_argument('--min-bytes', type=int, default=0,
+                            help='summarize subtrees smaller than this')
+        parser.add_argument('--allocated', action='store_true',
+                            help='use mem_allocated instead of walking the blocks')
+        parser.add_argument('context', nargs='*', default=['TopMemoryContext'])
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        root = gdb.parse_and_eval(' '.join(args.context))
+        if not int(root):
+            print('NULL memory context')
+            return
+        contexts = self.collect(int(root), args.allocated)
+        gdb.write('\n'.join(self.format_tree(contexts, args.min_bytes)) + '\n')
+MemoryContextTree()
+
+class BufferPool(gdb.Command):
+    """summarize the shared buffer pool from the buffer descriptors
+usage: pg buffers [--top N] [--pinned] [--chunk N]
+Counts used, dirty and pinned buffers, the usage count histogram and the
+relation forks holding the most buffers. --pinned lists the pinned buffers
+too. The descriptors are read CHUNK at a time and their state decoded in
+Python, which needs 9.6 or later. Shared memory is the same in every
+backend of a cluster, and in their cores."""
+
+    # BufferDesc.state bits of buf_internals.h, used when the macros are not
+    # in the debug info
+    state_bits = {'BUF_REFCOUNT_MASK': (1 << 18) - 1,
+                  'BUF_USAGECOUNT_MASK': 0xF << 18,
+                  'BUF_USAGECOUNT_SHIFT': 18,
+                  'BM_DIRTY': 1 << 23,
+                  'BM_VALID': 1 << 24,
+                  'BM_TAG_VALID': 1 << 25,
+                  'BM_IO_IN_PROGRESS': 1 << 26}
+    fork_names = {0: '', 1: '_fsm', 2: '_vm', 3: '_init'}
+    # the tag fields of 16 and later, then those of older versions
+    tag_fields = ('tag.spcOid', 'tag.dbOid', 'tag.relNumber',
+                  'tag.rnode.spcNode', 'tag.rnode.dbNode', 'tag.rnode.relNode',
+                  'tag.forkNum', 'state.value')
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg buffers", gdb.COMMAND_DATA)
+
+    def read_state_bits(self):
+        bits = {}
+        for name, default in self.state_bits.items():
+            try:
+                bits[name] = int(gdb.parse_and_eval(name))
+            except gdb.error:
+                bits[name] = default
+        return bits
+
+    def scan(self, chunk, list_pinned):
+        """Return (NBuffers, totals, usage count histogram, relation fork ->
+        [buffers, dirty, pinned, pins], pinned buffers if LIST_PINNED)"""
+        layout = types.layout('BufferDesc', self.tag_fields)
+        if 'state.value' not in layout:
+            raise gdb.GdbError('pg buffers needs BufferDesc.state, from 9.6 on')
+        # The decoded records are (tablespace, database, relation, fork,
+        # state) in offset order. Counting them keeps the loop over the
+        # descriptors in C, there are few distinct ones to decode after.
+        names = layout.record_names()
+        if names[-1] != 'state.value':
+            raise gdb.GdbError('unexpected BufferDesc layout')
+        pinned_layout = types.layout('BufferDesc', self.tag_fields + ('tag.blockNum',))
+        block = pinned_layout.record_names().index('tag.blockNum')
+        bits = self.read_state_bits()
+        refcount_mask = bits['BUF_REFCOUNT_MASK']
+        tag_valid = bits['BM_TAG_VALID']
+
+        descriptors = gdb.parse_and_eval('BufferDescriptors')
+        nbuffers = int(gdb.parse_and_eval('NBuffers'))
+        # the descriptors are padded to a cache line, BufferDescPadded
+        stride = descriptors.dereference().type.sizeof
+        base = int(descriptors)
+        inferior = gdb.selected_inferior()
+        pairs = collections.Counter()
+        pinned = []
+        for start in range(0, nbuffers, chunk):
+            count = min(chunk, nbuffers - start)
+            buf = inferior.read_memory(base + start * stride, count * stride)
+            pairs.update(layout.iter_unpack(buf, stride))
+            if not list_pinned:
+                continue
+            for buf_id, desc in enumerate(pinned_layout.iter_unpack(buf, stride), start):
+                value = desc[-1]
+                if value & tag_valid and value & refcount_mask:
+                    pinned.append((buf_id, desc[:4], desc[block],
+                                   value & refcount_mask))
+
+        totals = collections.Counter()
+        usage = collections.Counter()
+        relations = {}
+        for (*key, value), buffers in pairs.items():
+            if not value & tag_valid:
+                totals['free'] += buffers
+                continue
+            refcount = value & refcount_mask
+            usage[(value & bits['BUF_USAGECOUNT_MASK'])
+                  >> bits['BUF_USAGECOUNT_SHIFT']] += buffers
+            stats = relations.setdefault(tuple(key), [0, 0, 0, 0])
+            stats[0] += buffers
+            if value & bits['BM_DIRTY']:
+                stats[1] += buffers
+                totals['dirty'] += buffers
+            if refcount:
+                stats[2] += buffers
+                stats[3] += refcount * buffers
+                totals['pinned'] += buffers
+                totals['pins'] += refcount * buffers
+        totals['used'] = nbuffers - totals['free']
+        return (nbuffers, totals, usage, relations, pinned)
+
+    def relpath(self, key):
+        spc, db, rel, fork = key
+        return f'{spc}/{db}/{rel}{self.fork_names.get(fork, f"_{fork}")}'
+
+    def invoke(self, arg, from_tty):
+        parser = argparse.ArgumentParser(prog='pg buffers')
+        parser.add_argument('--top', type=int, default=20,
+                            help='number of relation forks shown')
+        parser.add_argument('--pinned', action='store_true',
+                            help='list the pinned buffers')
+        parser.add_argument('--chunk', type=int, default=65536,
+                            help='descriptors read at once')
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        nbuffers, totals, usage, relations, pinned = self.scan(args.chunk,
+                                                               args.pinned)
+        lines = [f"NBuffers {nbuffers}: {totals['used']} used, {totals['free']} free, "
+                 f"{totals['dirty']} dirty, {totals['pinned']} pinned "
+                 f"({totals['pins']} pins)",
+                 'usage count: ' + '  '.join(f'{count}: {usage[count]}'
+                                             for count in sorted(usage))]
+        top = sorted(relations.items(), key=lambda r: r[1][0], reverse=True)
+        lines.append(f"{'buffers':>10} {'dirty':>10} {'pinned':>7} {'pins':>7}  "
+                     "tablespace/database/relfilenode")
+        for key, (buffers, dirty, pinned_buffers, pins) in top[:args.top]:
+            lines.append(f'{buffers:>10} {dirty:>10} {pinned_buffers:>7} {pins:>7}  '
+                         f'{self.relpath(key)}')
+        if len(top) > args.top:
+            rest = top[args.top:]
+            lines.append(f'{sum(r[1][0] for r in rest):>10} '
+                         f'{sum(r[1][1] for r in rest):>10} in {len(rest)} more forks')
+        if args.pinned:
+            lines.append(f"{'buffer':>10} {'refcount':>10}  relation, block")
+            for buf_id, key, block, refcount in pinned:
+                lines.append(f'{buf_id + 1:>10} {refcount:>10}  {self.relpath(key)}, {block}')
+        gdb.write('\n'.join(lines) + '\n')
+BufferPool()
+
+def read_procs(fields):
+    """Return PGPROC address -> dict of FIELDS for every PGPROC in
+    ProcGlobal->allProcs, read as one array. Missing fields are None."""
+    proc_global = gdb.parse_and_eval('ProcGlobal')
+    base = int(proc_global['allProcs'])
+    count = int(proc_global['allProcCount'])
+    layout = types.layout('PGPROC', fields)
+    names = layout.record_names()
+    buf = gdb.selected_inferior().read_memory(base, layout.size * count)
+    return {base + i * layout.size: dict(dict.fromkeys(fields), **dict(zip(names, values)))
+            for i, values in enumerate(layout.iter_unpack(buf))}
+
+def find_cycles(graph):
+    """Return the cycles of GRAPH, node -> successors, as lists of nodes
+    (the strongly connected components of more than one node)"""
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+    for start in graph:
+        if start in index:
+            continue
+        index[start] = low[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(graph.get(start, ())))]
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = low[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph.get(succ, ()))))
+                    break
+                if succ in on_stack:
+                    low[node] = min(low[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1:
+                        cycles.append(component[::-1])
+    return cycles
+
+class LockGraph(gdb.Command):
+    """show who blocks whom in the heavyweight lock tables
+usage: pg locks [--all]
+Reads the shared lock and proclock hash tables and the PGPROCs, then prints
+each blocking backend which is not waiting itself with the tree of the
+backends waiting for it, and the deadlock cycles. --all lists every lock
+with its holders. Any backend of the cluster or a core will do. Only the
+holders conflicting with a waiter are followed, not the waiters queued
+ahead of it."""
+
+    lock_modes = (None, 'AccessShareLock', 'RowShareLock', 'RowExclusiveLock',
+                  'ShareUpdateExclusiveLock', 'ShareLock', 'ShareRowExclusiveLock',
+                  'ExclusiveLock', 'AccessExclusiveLock')
+    # LockConflicts of lock.c, used when the static is not in the debug info
+    conflicts = (0, 0x100, 0x180, 0x1e0, 0x1f0, 0x1d8, 0x1f8, 0x1fc, 0x1fe)
+    # LockTagType -> description of the four locktag fields
+    tag_formats = {
+        'LOCKTAG_RELATION': 'relation {1} of database {0}',
+        'LOCKTAG_RELATION_EXTEND': 'extension of relation {1} of database {0}',
+        'LOCKTAG_DATABASE_FROZEN_IDS': 'frozen ids of database {0}',
+        'LOCKTAG_PAGE': 'page {2} of relation {1} of database {0}',
+        'LOCKTAG_TUPLE': 'tuple ({2},{3}) of relation {1} of database {0}',
+        'LOCKTAG_TRANSACTION': 'transaction {0}',
+        'LOCKTAG_VIRTUALTRANSACTION': 'virtual transaction {0}/{1}',
+        'LOCKTAG_SPECULATIVE_TOKEN': 'speculative token {1} of transaction {0}',
+        'LOCKTAG_OBJECT': 'object {2}/{3} of class {1} of database {0}',
+        'LOCKTAG_ADVISORY': 'advisory lock {0}:{1}:{2}:{3}',
+    }
+    lock_fields = ('tag.locktag_field1', 'tag.locktag_field2', 'tag.locktag_field3',
+                   'tag.locktag_field4', 'tag.locktag_type', 'grantMask', 'waitMask')
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg locks", gdb.COMMAND_DATA)
+
+    def read_conflicts(self):
+        try:
+            table = gdb.parse_and_eval('LockConflicts')
+            low, high = table.type.range()
+            return tuple(int(table[i]) for i in range(low, high + 1))
+        except gdb.error:
+            return self.conflicts
+
+    def mode_names(self, mask):
+        return ', '.join(self.lock_modes[mode] if mode < len(self.lock_modes)
+                         else f'mode {mode}'
+                         for mode in range(1, mask.bit_length()) if mask & (1 << mode))
+
+    def read_locks(self):
+        """Return LOCK address -> fields of every entry of the lock hash"""
+        layout = types.layout('LOCK', self.lock_fields)
+        inferior = gdb.selected_inferior()
+        locks = {}
+        for lock in HashTable(gdb.parse_and_eval('LockMethodLockHash')):
+            locks[lock] = layout.unpack(inferior.read_memory(lock, layout.size))
+        return locks
+
+    def read_holders(self):
+        """Return LOCK address -> [(PGPROC address, hold mask)]"""
+        layout = types.layout('PROCLOCK', ('tag.myLock', 'tag.myProc', 'holdMask'))
+        holders = collections.defaultdict(list)
+        for proclock in HashTable(gdb.parse_and_eval('LockMethodProcLockHash')):
+            fields = layout.read(proclock)
+            if fields['holdMask']:
+                holders[fields['tag.myLock']].append((fields['tag.myProc'],
+                                                      fields['holdMask']))
+        return holders
+
+    def describe(self, lock, locks, tag_types):
+        fields = locks.get(lock)
+        if fields is None:
+            return f'lock {lock:#x}'
+        kind = tag_types.get(fields['tag.locktag_type'], str(fields['tag.locktag_type']))
+        values = [fields[f'tag.locktag_field{i}'] for i in range(1, 5)]
+        fmt = self.tag_formats.get(kind)
+        if fmt is None:
+            return f"{kind.replace('LOCKTAG_', '').lower()} {'/'.join(map(str, values))}"
+        return fmt.format(*values)
+
+    def invoke(self, arg, from_tty):
+        parser = argparse.ArgumentParser(prog='pg locks')
+        parser.add_argument('--all', action='store_true', help='list every lock')
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        conflicts = self.read_conflicts()
+        tag_types = {f.enumval: f.name
+                     for f in types.lookup('LockTagType').strip_typedefs().fields()}
+        procs = read_procs(('pid', 'waitLock', 'waitLockMode'))
+        locks = self.read_locks()
+        holders = self.read_holders()
+
+        def label(proc):
+            pid = procs[proc]['pid'] if proc in procs else None
+            return f'pid {pid}' if pid else f'prepared transaction {proc:#x}'
+
+        # waiter -> holders it conflicts with, and the reverse
+        blockers = {}
+        blocked = collections.defaultdict(list)
+        queued = []
+        for proc, fields in procs.items():
+            lock = fields['waitLock']
+            if not lock:
+                continue
+            wanted = conflicts[fields['waitLockMode']]
+            blockers[proc] = [holder for holder, mask in holders.get(lock, ())
+                              if holder != proc and mask & wanted]
+            for holder in blockers[proc]:
+                blocked[holder].append(proc)
+            if not blockers[proc]:
+                queued.append(proc)
+
+        def waits(proc):
+            fields = procs[proc]
+            return (f"waits for {self.lock_modes[fields['waitLockMode']]} on "
+                    f"{self.describe(fields['waitLock'], locks, tag_types)}")
+
+        lines = []
+        shown = set()
+        def tree(root, head):
+            stack = [(root, 0, head)]
+            while stack:
+                proc, depth, text = stack.pop()
+                lines.append('  ' * depth + text)
+                if proc in shown:
+                    continue
+                shown.add(proc)
+                for waiter in reversed(blocked.get(proc, ())):
+                    lock = procs[waiter]['waitLock']
+                    held = dict(holders.get(lock, ())).get(proc, 0)
+                    stack.append((waiter, depth + 1, f'{label(waiter)} {waits(waiter)}, '
+                                  f'held as {self.mode_names(held)}'
+                                  + (' (already shown)' if waiter in shown else '')))
+
+        roots = sorted((p for p in blocked if p not in blockers),
+                       key=lambda p: -len(blocked[p]))
+        for root in roots:
+            tree(root, f'{label(root)} is not waiting and blocks {len(blocked[root])}')
+        for cycle in find_cycles(blockers):
+            lines.append('deadlock: ' + ' -> '.join(label(p) for p in cycle + cycle[:1]))
+            for proc in cycle:
+                if proc not in shown:
+                    tree(proc, f'{label(proc)} {waits(proc)}')
+        for proc in queued:
+            lines.append(f'{label(proc)} {waits(proc)}, queued behind other waiters')
+        if not lines:
+            lines.append(f'no backend waits for a lock, {len(locks)} locks')
+        if args.all:
+            lines.append('')
+            for lock, fields in locks.items():
+                granted = ', '.join(f'{label(proc)} ({self.mode_names(mask)})'
+                                    for proc, mask in holders.get(lock, ()))
+                lines.append(f'{self.describe(lock, locks, tag_types)}: '
+                             f'granted to {granted or "none"}'
+                             + (f"; awaited {self.mode_names(fields['waitMask'])}"
+                                if fields['waitMask'] else ''))
+        gdb.write('\n'.join(lines) + '\n')
+LockGraph()
+
+class HashTableDump(gdb.Command):
+    """show a dynahash table and its entries
+usage: pg htab [--limit N] EXPR [TYPE]
+EXPR is an HTAB pointer, e.g. RelationIdCache. Shows the entry count, the
+fill factor and how many buckets have chains of each length; given TYPE,
+the entry struct, also the first N entries (100 by default) cast to it."""
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg htab", gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        parser = argparse.ArgumentParser(prog='pg htab')
+        parser.add_argument('--limit', type=int, default=100,
+                            help='number of entries shown')
+        parser.add_argument('expr')
+        parser.add_argument('type', nargs='?')
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        htab = gdb.parse_and_eval(args.expr)
+        if not int(htab):
+            print('NULL hash table')
+            return
+        table = HashTable(htab)
+        lengths = table.chain_lengths()
+        lines = [table.summary(lengths), f"{'chain length':>12} {'buckets':>10}"]
+        lines += [f'{length:>12} {lengths[length]:>10}' for length in sorted(lengths)]
+        if args.type:
+            typ = gdb.lookup_type(args.type)
+            cvar = AutoNumCVar()
+            for number, entry in enumerate(table.entries(typ)):
+                if number == args.limit:
+                    lines.append(f'... {table.nentries - number} more entries')
+                    break
+                lines.append(f'{cvar.set_var(entry)} ({typ} *) {int(entry):#x} '
+                             f'{entry.dereference()}')
+        gdb.write('\n'.join(lines) + '\n')
+HashTableDump()
+
+class SimpleHashDump(gdb.Command):
+    """show the fill of a simplehash or dshash table
+usage: pg simplehash [--hash FIELD] EXPR
+       pg simplehash --list
+EXPR points to a simplehash instantiation, e.g. a TupleHashTable's
+hashtab, or to a dshash_table. Shows the size, members and load factor,
+and the maximum probe distance of a simplehash table, which needs the hash
+of the elements: their 'hash' field, --hash FIELD, or a known function of
+their key. A dshash table shows its partitions and longest bucket chain.
+--list lists the simplehash instantiations of the debug info."""
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg simplehash", gdb.COMMAND_DATA)
+        self.instantiations = None
+        gdb.events.new_objfile.connect(self.drop_instantiations)
+        gdb.events.clear_objfiles.connect(self.drop_instantiations)
+
+    def drop_instantiations(self, event=None):
+        self.instantiations = None
+
+    def invoke(self, arg, from_tty):
+        parser = argparse.ArgumentParser(prog='pg simplehash')
+        parser.add_argument('--list', action='store_true',
+                            help='list the simplehash instantiations')
+        parser.add_argument('--hash', help='element field holding its hash')
+        parser.add_argument('expr', nargs='*')
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        if args.list or not args.expr:
+            if self.instantiations is None:
+                self.instantiations = find_simplehash_types()
+            print('\n'.join(self.instantiations))
+            return
+        val = gdb.parse_and_eval(' '.join(args.expr))
+        if not int(val):
+            print('NULL hash table')
+            return
+        name = val.type.strip_typedefs().target().tag
+        if name == 'dshash_table':
+            stats = DshashTable(val).stats()
+            print(f"dshash_table with {stats['members']} entries in {stats['size']} "
+                  f"buckets, load factor {stats['load_factor']:.2f}, "
+                  f"longest chain {stats['max_chain']}, {stats['partitions']} "
+                  f"partitions of {stats['min_partition']} to "
+                  f"{stats['max_partition']} entries")
+            return
+        stats = SimpleHashTable(val, args.hash).stats()
+        text = f"{name} with {stats['members']} members in {stats['size']} buckets, " \
+            f"load factor {stats['load_factor']:.2f}, longest run {stats['longest_run']}"
+        if 'max_probe' in stats:
+            text += f", probe distance {stats['avg_probe']:.2f} average, " \
+                f"{stats['max_probe']} max"
+        if stats['in_use'] != stats['members']:
+            text += f", {stats['in_use']} buckets in use"
+        print(text)
+SimpleHashDump()
+
+class ProcSnapshot(gdb.Command):
+    """show the backends from PGPROC and the backend status array
+usage: pg procs [--query-bytes N] [--active]
+Like pg_stat_activity: pid, state, wait event, xid, xmin, database oid and
+the start of the query, N bytes (60 by default). --active skips idle
+backends. The arrays are read from shared memory at once, so any backend
+of the cluster or a core will do."""
+
+    # wait_event_info class bits of utils/wait_event.h
+    wait_classes = {0x01000000: 'LWLock', 0x03000000: 'Lock',
+                    0x04000000: 'BufferPin', 0x05000000: 'Activity',
+                    0x06000000: 'Client', 0x07000000: 'Extension',
+                    0x08000000: 'IPC', 0x09000000: 'Timeout', 0x0A000000: 'IO',
+                    0x0B000000: 'InjectionPoint'}
+    # enums naming the events of a class
+    wait_enums = ('WaitEventActivity', 'WaitEventClient', 'WaitEventIPC',
+                  'WaitEventTimeout', 'WaitEventIO', 'WaitEventBufferPin',
+                  'WaitEventExtension')
+    states = {'STATE_UNDEFINED': '', 'STATE_IDLE': 'idle', 'STATE_RUNNING': 'active',
+              'STATE_IDLEINTRANSACTION': 'idle in transaction',
+              'STATE_FASTPATH': 'fastpath function call',
+              'STATE_IDLEINTRANSACTION_ABORTED': 'idle in transaction (aborted)',
+              'STATE_DISABLED': 'disabled', 'STATE_STARTING': 'starting'}
+    status_fields = ('st_procpid', 'st_state', 'st_databaseid',
+                     'st_activity_raw', 'st_activity')
+
+    def __init__ (self):
+        super (self.__class__, self).__init__ ("pg procs", gdb.COMMAND_DATA)
+        # wait_event_info -> (class, event) names
+        self.wait_events = None
+        gdb.events.new_objfile.connect(self.drop_wait_events)
+        gdb.events.clear_objfiles.connect(self.drop_wait_events)
+
+    def drop_wait_events(self, event=None):
+        self.wait_events = None
+
+    @staticmethod
+    def camel_case(name):
+        return ''.join(word.capitalize() for word in name.split('_'))
+
+    def read_wait_events(self):
+        self.wait_events = {}
+        for enum in self.wait_enums:
+            try:
+                fields = types.lookup(enum).strip_typedefs().fields()
+            except gdb.error:
+                continue
+            for field in fields:
+                name = field.name.replace('WAIT_EVENT_', '', 1)
+                self.wait_events[field.enumval] = self.camel_case(name)
+        try:
+            for field in types.lookup('LockTagType').strip_typedefs().fields():
+                name = field.name.replace('LOCKTAG_', '', 1).lower()
+                self.wait_events[0x03000000 | field.enumval] = name
+        except gdb.error:
+            pass
+
+    def wait_event(self, info):
+        """Return the (type, name) of WAIT_EVENT_INFO"""
+        if not info:
+            return ('', '')
+        if self.wait_events is None:
+            self.read_wait_events()
+        wait_class = info & 0xFF000000
+        class_name = self.wait_classes.get(wait_class, f'{wait_class:#x}')
+        name = self.wait_events.get(info)
+        if name is None:
+            name = f'tranche {info & 0xFFFF}' if class_name == 'LWLock' \
+                else str(info & 0xFFFF)
+        return (class_name, name)
+
+    def status_slots(self, procs):
+        try:
+            return int(gdb.parse_and_eval('NumBackendStatSlots'))
+        except gdb.error:
+            pass
+        try:
+            return int(gdb.parse_and_eval('MaxBackends + NUM_AUXPROCTYPES'))
+        except gdb.error:
+            return len(procs)
+
+    def read_status(self, procs, query_bytes):
+        """Return pid -> (state, database, query) of the backend status array"""
+        array = int(gdb.parse_and_eval('BackendStatusArray'))
+        if not array:
+            return {}
+        slots = self.status_slots(procs)
+        layout = types.layout('PgBackendStatus', self.status_fields)
+        names = layout.record_names()
+        inferior = gdb.selected_inferior()
+        # every st_activity points into this buffer of query_size bytes a slot
+        activity = int(gdb.parse_and_eval('BackendActivityBuffer'))
+        query_size = int(gdb.parse_and_eval('pgstat_track_activity_query_size'))
+        queries = inferior.read_memory(activity, query_size * slots).tobytes() \
+            if activity else b''
+        states = {f.enumval: self.states.get(f.name, f.name)
+                  for f in types.lookup('BackendState').strip_typedefs().fields()}
+        status = {}
+        buf = inferior.read_memory(array, layout.size * slots)
+        for values in layout.iter_unpack(buf):
+            fields = dict(dict.fromkeys(self.status_fields), **dict(zip(names, values)))
+            if not fields['st_procpid']:
+                continue
+            pointer = fields['st_activity_raw'] or fields['st_activity'] or 0
+            start = pointer - activity
+            query = ''
+            if 0 <= start < len(queries):
+                raw = queries[start:start + min(query_bytes, query_size)]
+                query = raw.split(b'\0', 1)[0].decode(errors='replace')
+            status[fields['st_procpid']] = (states.get(fields['st_state'], ''),
+                                            fields['st_databaseid'], query)
+        return status
+
+    def read_xids(self, procs):
+        """Return PGPROC address -> (xid, xmin), from the PGXACT array
+        before 14"""
+        xids = {}
+        first = min(procs)
+        layout = types.layout('PGXACT', ('xid', 'xmin'))
+        buf = gdb.selected_inferior().read_memory(
+            int(gdb.parse_and_eval('ProcGlobal->allPgXact')), layout.size * len(procs))
+        proc_size = types.lookup('PGPROC').sizeof
+        for index, (xid, xmin) in enumerate(layout.iter_unpack(buf)):
+            xids[first + index * proc_size] = (xid, xmin)
+        return xids
+
+    def invoke(self, arg, from_tty):
+        parser = argparse.ArgumentParser(prog='pg procs')
+        parser.add_argument('--query-bytes', type=int, default=60,
+                            help='bytes of the query shown')
+        parser.add_argument('--active', action='store_true',
+                            help='skip the idle backends')
+        args = parser.parse_args(gdb.string_to_argv(arg))
+        procs = read_procs(('pid', 'xid', 'xmin', 'databaseId', 'wait_event_info'))
+        xids = None
+        if any(fields['xid'] is None for fields in procs.values()):
+            xids = self.read_xids(procs)
+        status = self.read_status(procs, args.query_bytes)
+        lines = [f"{'pid':>8} {'state':<20} {'wait_event_type':<15} {'wait_event':<24} "
+                 f"{'xid':>10} {'xmin':>10} {'datid':>8}  query"]
+        for address, fields in procs.items():
+            pid = fields['pid']
+            if not pid:
+                continue
+            state, database, query = status.get(pid, ('', fields['databaseId'], ''))
+            if args.active and state.startswith('idle'):
+                continue
+            xid, xmin = xids[address] if xids else (fields['xid'], fields['xmin'])
+            wait_type, wait_name = self.wait_event(fields['wait_event_info'])
+            lines.append(f'{pid:>8} {state:<20} {wait_type:<15} {wait_name:<24} '
+                         f'{xid or "":>10} {xmin or "":>10} {database:>8}  '
+                         + query.replace('\n', ' '))
+        gdb.write('\n'.join(lines) + '\n')
+ProcSnapshot()
+
 class ListPrinter:
     """Pretty-printer for List."""
     def __init__(self, val):
@@ -307,6 +2812,20 @@ class ListPrinter:
             cvar = autocvar.set_var(elt.value)
             yield (str(i), elt.to_string(cvar))
 
+class HTABPrinter:
+    """Pretty-printer for HTAB, the chains are only walked in tables of
+    up to max_entries entries."""
+    max_entries = 1 << 20
+
+    def __init__(self, val):
+        self.table = HashTable(val.address)
+
+    def to_string(self):
+        lengths = None
+        if self.table.nentries <= self.max_entries:
+            lengths = self.table.chain_lengths()
+        return self.table.summary(lengths)
+
 def register_pretty_printer(objfile):
     """A routine to register a pretty-printer against the given OBJFILE."""
     objfile.pretty_printers.append(type_lookup_function)
@@ -319,6 +2838,8 @@ def type_lookup_function(val):
     name = val.type.name
     if name == "List":
         return ListPrinter(val)
+    if (tag == "HTAB" or name == "HTAB") and val.address is not None:
+        return HTABPrinter(val)
     return None
 
 if __name__ == "__main__":
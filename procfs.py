@@ -0,0 +1,161 @@
+import os
+import re
+import time
+from collections import namedtuple
+
+# A postgres child process as seen from /proc. start_time and cpu_time are in
+# clock ticks since boot, cpu_time is user plus system time.
+Backend = namedtuple('Backend', ['pid', 'backend_type', 'user', 'database',
+                                 'client', 'state', 'title', 'start_time',
+                                 'cpu_time'])
+
+# Process titles of processes which are not client backends, the rest of the
+# title after them is a database or a description.
+AUX_TITLES = ('checkpointer', 'background writer', 'walwriter', 'walreceiver',
+              'walsummarizer', 'autovacuum launcher', 'autovacuum worker',
+              'logical replication launcher', 'logical replication worker',
+              'logical replication apply worker',
+              'logical replication parallel apply worker',
+              'logical replication tablesync worker', 'parallel worker',
+              'archiver', 'stats collector', 'startup', 'slotsync worker',
+              'io worker', 'checksum worker')
+
+# user, database (not shown by physical walsenders), client and activity
+CLIENT_TITLE = re.compile(r'(\S+) (?:(\S+) )?(\[local\]|\S+\(\d+\)) ?(.*)')
+
+def parse_title(title):
+    """Split a process title into (backend type, user, database, client, state)"""
+    match = re.match(r'postgres: (?:\S+: )?(.*)', title)
+    if not match:
+        return ('unknown', '', '', '', '')
+    rest = match.group(1).strip()
+    for aux in AUX_TITLES:
+        if rest == aux or rest.startswith(aux + ' '):
+            database = rest[len(aux):].strip() if aux == 'autovacuum worker' else ''
+            return (aux, '', database, '', '')
+    walsender = rest.startswith('walsender ')
+    if walsender:
+        rest = rest[len('walsender '):]
+    match = CLIENT_TITLE.match(rest)
+    if not match:
+        return ('unknown', '', '', '', '')
+    user, database, client, activity = match.groups()
+    database = database or ''
+    if walsender:
+        return ('walsender', user, database, client, activity)
+    if activity.startswith('idle') or activity in ('authentication', 'startup'):
+        state = activity
+    elif activity.endswith(' waiting'):
+        state = 'waiting'
+    else:
+        state = 'active'
+    return ('client backend', user, database, client, state)
+
+class ProcScanner(object):
+    """Enumerate the children of a postmaster through /proc"""
+
+    def __init__(self, proc='/proc', max_age=1.0):
+        self.proc = proc
+        self.max_age = max_age
+        # (postmaster pid, start time) -> (scan time, backends)
+        self.results = {}
+        # (pid, start time) -> parsed title of a child, a title only changes
+        # its state while the process lives
+        self.titles = {}
+
+    def read_stat(self, pid):
+        """Return (ppid, start time, cpu time) of PID, or None if it is gone"""
+        try:
+            with open(os.path.join(self.proc, str(pid), 'stat'), 'rb') as f:
+                stat = f.read()
+        except OSError:
+            return None
+        # the command name may contain spaces and parentheses
+        fields = stat[stat.rindex(b')') + 2:].split()
+        return (int(fields[1]), int(fields[19]),
+                int(fields[11]) + int(fields[12]))
+
+    def read_title(self, pid):
+        try:
+            with open(os.path.join(self.proc, str(pid), 'cmdline'), 'rb') as f:
+                cmdline = f.read()
+        except OSError:
+            return None
+        # the title overwrites argv and is padded with NUL bytes
+        args = [a for a in cmdline.split(b'\0') if a]
+        return b' '.join(args).decode(errors='replace').strip()
+
+    def children(self, ppid):
+        """Return the pids of the children of PPID"""
+        path = os.path.join(self.proc, str(ppid), 'task', str(ppid), 'children')
+        try:
+            with open(path) as f:
+                return [int(pid) for pid in f.read().split()]
+        except OSError:
+            pass
+        # kernel without CONFIG_PROC_CHILDREN, scan every process
+        pids = []
+        for name in os.listdir(self.proc):
+            if not name.isdigit():
+                continue
+            stat = self.read_stat(name)
+            if stat is not None and stat[0] == ppid:
+                pids.append(int(name))
+        return pids
+
+    def scan(self, master_pid, refresh=False):
+        """Return the Backend records of the children of MASTER_PID"""
+        stat = self.read_stat(master_pid)
+        if stat is None:
+            return []
+        key = (master_pid, stat[1])
+        now = time.monotonic()
+        cached = self.results.get(key)
+        if not refresh and cached is not None and now - cached[0] < self.max_age:
+            return cached[1]
+        if cached is None:
+            # the postmaster is new or restarted, forget the old one
+            self.results.clear()
+        titles = {}
+        backends = []
+        for pid in sorted(self.children(master_pid)):
+            stat = self.read_stat(pid)
+            title = self.read_title(pid)
+            if stat is None or title is None:
+                continue
+            ident = (pid, stat[1])
+            parsed = self.titles.get(ident)
+            if parsed is None or parsed[0] != title:
+                parsed = (title, parse_title(title))
+            titles[ident] = parsed
+            backend_type, user, database, client, state = parsed[1]
+            backends.append(Backend(pid, backend_type, user, database, client,
+                                    state, title, stat[1], stat[2]))
+        self.titles = titles
+        self.results[key] = (now, backends)
+        return backends
+
+    def cpu_usage(self, pids, interval):
+        """Return pid -> fraction of a CPU each of PIDS used during INTERVAL"""
+        before = {pid: self.read_stat(pid) for pid in pids}
+        time.sleep(interval)
+        ticks = os.sysconf('SC_CLK_TCK') * interval
+        usage = {}
+        for pid, stat in before.items():
+            after = self.read_stat(pid)
+            # skip processes which exited or were replaced meanwhile
+            if stat is None or after is None or after[1] != stat[1]:
+                continue
+            usage[pid] = (after[2] - stat[2]) / ticks
+        return usage
+
+    def scan_datadir(self, datadir, refresh=False):
+        """Return the children of the postmaster running on DATADIR"""
+        pidfile = os.path.expanduser(os.path.join(datadir, 'postmaster.pid'))
+        with open(pidfile) as f:
+            master_pid = f.readline().strip()
+        if not master_pid:
+            return []
+        return self.scan(int(master_pid), refresh)
+
+__all__ = ['Backend', 'ProcScanner', 'parse_title']